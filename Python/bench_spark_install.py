@@ -0,0 +1,237 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+
+try:
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+import spark_install
+
+PHASES = ["catalog", "find", "download", "extract", "configure", "env"]
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    # Serves files with Range and ETag support, like the mirrors spark_install talks to
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        requested_range = self.headers.get("Range")
+        self.server.requests.append((self.path, requested_range))
+        path = os.path.join(self.server.directory, self.path.lstrip("/").split("?")[0])
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        stat = os.stat(path)
+        etag = '"%x-%x"' % (int(stat.st_mtime * 1000000), stat.st_size)
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        start, end = 0, stat.st_size - 1
+        match = re.match(r"bytes=(\d+)-(\d*)$", requested_range or "")
+        if self.server.ranges and match:
+            start = int(match.group(1))
+            if start in self.server.fail_offsets:
+                self.send_error(500)
+                return
+            end = min(int(match.group(2) or end), end)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, stat.st_size))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("ETag", etag)
+        self.end_headers()
+
+        remaining = end - start + 1
+        with open(path, "rb") as f:
+            f.seek(start)
+            while remaining > 0:
+                block = f.read(min(remaining, 256 * 1024))
+                if not block:
+                    break
+                self.wfile.write(block)
+                remaining -= len(block)
+                if self.server.throttle:
+                    time.sleep(self.server.throttle)
+
+
+class LocalServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_directory(directory, ranges=True):
+    server = LocalServer(("127.0.0.1", 0), RangeRequestHandler)
+    server.directory = directory
+    server.requests = []
+    server.ranges = ranges
+    server.fail_offsets = set()
+    server.throttle = 0
+    server.url = "http://127.0.0.1:%d/" % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def make_spark_archive(path, spark_version, hadoop_version, extra_files=None, mode="w:gz"):
+    import io
+    import tarfile
+    component = "spark-%s-bin-hadoop%s" % (spark_version, hadoop_version)
+    files = {"conf/log4j.properties.template": b"log4j.rootCategory=INFO, console\n",
+             "conf/spark-defaults.conf.template": b"# spark.master  spark://master:7077\n",
+             "python/lib/py4j-src.zip": b"py4j",
+             "python/lib/pyspark.zip": b"pyspark",
+             "jars/spark-core.jar": b"core" * 1024,
+             "bin/spark-submit": b"#!/bin/sh\n"}
+    files.update(extra_files or {})
+    with tarfile.open(path, mode) as tf:
+        for name, data in sorted(files.items()):
+            member = tarfile.TarInfo(component + "/" + name)
+            member.size = len(data)
+            member.mode = 0o755 if name.startswith("bin/") else 0o644
+            tf.addfile(member, io.BytesIO(data))
+    return component
+
+
+def _synthetic_files(size, count):
+    # Random bytes compress about as badly as the jars that make up most of a real distribution
+    per_file = max(1, size // count)
+    return dict(("jars/synthetic-%05d.jar" % i, os.urandom(per_file)) for i in range(count))
+
+
+def _timed(timings, phase, fn, *args, **kwargs):
+    started = time.time()
+    result = fn(*args, **kwargs)
+    timings[phase] = time.time() - started
+    return result
+
+
+def run_scenario(served_dir, server, size, count, repeat=3):
+    spark_version, hadoop_version = "9.%d.%d" % (size // (1024 * 1024), count), "2.7"
+    package = "spark-%s-bin-hadoop%s.tgz" % (spark_version, hadoop_version)
+    make_spark_archive(os.path.join(served_dir, package), spark_version, hadoop_version, _synthetic_files(size, count))
+    with open(os.path.join(served_dir, "versions.json"), "w") as f:
+        json.dump([{"spark": spark_version, "hadoop": hadoop_version,
+                    "base": server.url, "pattern": "spark-%s-bin-hadoop%s.tgz"}], f)
+
+    runs = []
+    for i in range(repeat):
+        install_dir = tempfile.mkdtemp(prefix="bench-spark-")
+        os.environ["SPARK_INSTALL_DIR"] = install_dir
+        spark_install._catalog = spark_install._VersionCatalog()
+        timings = {}
+        try:
+            _timed(timings, "catalog", spark_install.spark_versions_initialize)
+            info = _timed(timings, "find", spark_install.spark_install_find, spark_version, hadoop_version, installed_only=False)
+            _timed(timings, "download", spark_install._spark_install_fetch, info)
+            _timed(timings, "extract", spark_install._spark_install_extract, info)
+            _timed(timings, "configure", spark_install._spark_install_configure, info)
+            _timed(timings, "env", spark_install.spark_set_env_vars, info["spark_version_dir"], persist=False)
+        finally:
+            shutil.rmtree(install_dir, ignore_errors=True)
+        runs.append(timings)
+
+    phases = {}
+    for phase in PHASES:
+        values = sorted(run[phase] for run in runs)
+        phases[phase] = {"min": values[0], "median": values[len(values) // 2]}
+    archive_size = os.path.getsize(os.path.join(served_dir, package))
+    phases["download"]["throughput"] = archive_size / max(phases["download"]["min"], 1e-9)
+    return {"scenario": "size=%dMiB,files=%d" % (size // (1024 * 1024), count),
+            "archive_bytes": archive_size, "phases": phases}
+
+
+def _git_commit():
+    import subprocess
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.STDOUT,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode("utf-8").strip()
+    except Exception:
+        return None
+
+
+def run_benchmarks(sizes, counts, repeat=3):
+    import platform
+    served_dir = tempfile.mkdtemp(prefix="bench-served-")
+    server = serve_directory(served_dir)
+    versions_url = spark_install.SPARK_VERSIONS_URL
+    environ = dict(os.environ)
+    spark_install.SPARK_VERSIONS_URL = server.url + "versions.json"
+    os.environ["SPARK_INSTALL_MIRRORS"] = ""
+    try:
+        results = [run_scenario(served_dir, server, size, count, repeat) for size in sizes for count in counts]
+    finally:
+        spark_install.SPARK_VERSIONS_URL = versions_url
+        os.environ.clear()
+        os.environ.update(environ)
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(served_dir, ignore_errors=True)
+    return {"commit": _git_commit(), "python": platform.python_version(), "platform": sys.platform,
+            "timestamp": time.time(), "repeat": repeat, "results": results}
+
+
+def compare_benchmarks(baseline, current, threshold=1.2):
+    # Returns a row per phase present in both runs, flagged as a regression when it got slower
+    # than threshold times the baseline
+    rows = []
+    previous = dict((r["scenario"], r["phases"]) for r in baseline["results"])
+    for result in current["results"]:
+        for phase in PHASES:
+            if result["scenario"] not in previous or phase not in previous[result["scenario"]]:
+                continue
+            before = previous[result["scenario"]][phase]["median"]
+            after = result["phases"][phase]["median"]
+            rows.append({"scenario": result["scenario"], "phase": phase, "baseline": before, "current": after,
+                         "regression": after > before * threshold and after - before > 0.01})
+    return rows
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Spark Installation Benchmarks")
+    parser.add_argument("--sizes", help="Comma separated archive sizes in MiB", default="8,64")
+    parser.add_argument("--files", help="Comma separated file counts per archive", default="100,2000")
+    parser.add_argument("--repeat", help="Runs per scenario", type=int, default=3)
+    parser.add_argument("--output", help="Write the results as JSON to this file", default="bench_spark_install.json")
+    parser.add_argument("--compare", help="Baseline results to compare against")
+    parser.add_argument("--threshold", help="Slowdown ratio reported as a regression", type=float, default=1.2)
+    args = parser.parse_args()
+
+    sizes = [int(s) * 1024 * 1024 for s in args.sizes.split(",")]
+    counts = [int(c) for c in args.files.split(",")]
+    results = run_benchmarks(sizes, counts, args.repeat)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Results written to %s" % args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        rows = compare_benchmarks(baseline, results, args.threshold)
+        for row in rows:
+            print("{:<24}{:<12}{:>10.4f}s{:>10.4f}s{:>8.2f}x".format(row["scenario"], row["phase"], row["baseline"], row["current"],
+                                                                   row["current"] / max(row["baseline"], 1e-9)))
+        regressions = [row for row in rows if row["regression"]]
+        if regressions:
+            print("Regressions against %s (%s):" % (args.compare, baseline.get("commit")))
+            for row in regressions:
+                print("  %s %s: %.4fs -> %.4fs" % (row["scenario"], row["phase"], row["baseline"], row["current"]))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,7 @@ from setuptools import setup, find_packages
 from codecs import open
 from os import path
 import subprocess
+import sys
 
 here = path.abspath(path.dirname(__file__))
 
@@ -46,13 +47,13 @@ setup(
         'Programming Language :: Python :: 2',
         'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
         'Programming Language :: Python :: 3.5',
     ],
+    python_requires='>=2.7, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*, !=3.4.*',
 
     # What does your project relate to?
     keywords='Apache Spark PySpark Hadoop WinUtils',
 
-    py_modules=["spark_install"]
+    # The asyncio API needs Python 3.5, so Python 2 builds leave it out
+    py_modules=["spark_install"] + (["spark_install_async"] if sys.version_info >= (3, 5) else [])
 )
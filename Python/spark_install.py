@@ -3,55 +3,939 @@ import re
 import sys
 import shutil
 import logging
+import threading
+from contextlib import contextmanager
 
 SPARK_VERSIONS_FILE_PATTERN = "spark-(.*)-bin-(?:hadoop)?(.*)"
 SPARK_VERSIONS_URL = "https://raw.githubusercontent.com/rstudio/spark-install/master/common/versions.json"
 WINUTILS_URL = "https://github.com/steveloughran/winutils/archive/master.zip"
 
+DOWNLOAD_THREADS = 4
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+DOWNLOAD_BLOCK_SIZE = 64 * 1024
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_TIMEOUT = 60
+
+VERSIONS_TTL_DAYS = 30
+
+# Tried after the base and mirrors of each versions.json entry, overridden by a comma separated
+# SPARK_INSTALL_MIRRORS. {spark} and {hadoop} are replaced with the requested versions.
+SPARK_MIRRORS = ["https://archive.apache.org/dist/spark/spark-{spark}/"]
+MIRRORS_TTL_HOURS = 24
+MIRROR_PROBE_SIZE = 64 * 1024
+MIRROR_PROBE_TIMEOUT = 10
+
+# Java major versions supported by each Spark release line
+SPARK_JAVA_COMPATIBILITY = {
+    "1": [7, 8],
+    "2.0": [7, 8],
+    "2.1": [7, 8],
+    "2.2": [8],
+    "2.3": [8],
+    "2.4": [8],
+    "3.0": [8, 11],
+    "3.1": [8, 11],
+    "3.2": [8, 11],
+    "3.3": [8, 11, 17],
+    "3.4": [8, 11, 17],
+    "3.5": [8, 11, 17],
+    "4": [17, 21],
+}
+
+CACHE_MAX_SIZE = 10 * 1024 * 1024 * 1024
+# The cache is shared by every user in the cache directory's group
+CACHE_DIR_MODE = 0o2775
+CACHE_FILE_MODE = 0o664
+
+EXTRACT_THREADS = 8
+
+DEDUP_MIN_SIZE = 4096
+INSTALL_LOCK_TIMEOUT = 60 * 60
+
+# Globs are matched against paths inside spark_version_dir, "*" also matches "/"
+SPARK_INSTALL_PROFILES = {
+    "full": {"include": ["*"], "exclude": []},
+    "python-minimal": {"include": ["RELEASE", "bin/*", "sbin/*", "conf/*", "jars/*", "python/lib/*"], "exclude": []},
+    "r": {"include": ["RELEASE", "bin/*", "sbin/*", "conf/*", "jars/*", "R/*"], "exclude": []},
+}
+EXTRACT_MAX_PENDING = 64 * 1024 * 1024
+
+UPGRADE_RANGE_GAP = 64 * 1024
+
 NL = os.linesep
 
-def _verify_java():
+def _which(name):
+    extensions = [""] + (os.getenv("PATHEXT", ".EXE").split(os.pathsep) if sys.platform == "win32" else [])
+    for directory in os.getenv("PATH", "").split(os.pathsep):
+        for extension in extensions:
+            candidate = os.path.join(directory, name + extension)
+            if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+                return candidate
+    return None
+
+
+def _java_major(version):
+    # "1.8.0_181" is Java 8, "11.0.2" and "17" are Java 11 and 17
+    parts = re.findall(r"\d+", version)
+    if not parts:
+        return None
+    if parts[0] == "1" and len(parts) > 1:
+        return int(parts[1])
+    return int(parts[0])
+
+
+def _java_release_version(binary):
+    # JDKs ship a release file next to bin/ (or one level up for a JDK 8 jre/bin/java)
+    home = os.path.dirname(os.path.dirname(binary))
+    for release in (os.path.join(home, "release"), os.path.join(os.path.dirname(home), "release")):
+        if os.path.isfile(release):
+            with open(release) as rf:
+                match = re.search(r'^JAVA_VERSION="?([^"\n]+)"?', rf.read(), re.MULTILINE)
+            if match:
+                return match.group(1)
+    return None
+
+
+def _java_exec_version(binary):
     import subprocess
+    output = subprocess.check_output([binary, "-version"], stderr=subprocess.STDOUT)
+    logging.debug(output)
+    match = re.search(br'version "([^"]+)"', output)
+    return match.group(1).decode("utf-8") if match else None
+
+
+def spark_java_info():
+    # Resolves java from JAVA_HOME or PATH and reads its version from the JDK release file when
+    # possible. Results are cached per binary path and mtime so repeated runs never start a JVM.
+    import json
+    java_name = "java.exe" if sys.platform == "win32" else "java"
+    java_home = os.getenv("JAVA_HOME")
+    binary = None
+    if java_home and os.path.isfile(os.path.join(java_home, "bin", java_name)):
+        binary = os.path.join(java_home, "bin", java_name)
+    else:
+        binary = _which("java")
+    if not binary:
+        return None
+    binary = os.path.realpath(binary)
+    mtime = os.stat(binary).st_mtime
+
+    spark_can_install()
+    cache_file = os.path.join(spark_install_dir(), ".java.json")
     try:
-        import re
-        output = subprocess.check_output(["java", "-version"], stderr=subprocess.STDOUT)
-        logging.debug(output)
+        with open(cache_file) as cf:
+            cache = json.load(cf)
+    except (IOError, OSError, ValueError):
+        cache = {}
+    cached = cache.get(binary)
+    if cached and cached["mtime"] == mtime:
+        return cached["info"]
+
+    version, source = _java_release_version(binary), "release"
+    if version is None:
+        try:
+            version, source = _java_exec_version(binary), "exec"
+        except Exception as e:
+            logging.debug("Could not run %s -version: %s" % (binary, e))
+    if version is None:
+        return None
 
-        match = re.search(b"(\d+\.\d+)", output)
+    info = {"path": binary, "version": version, "major": _java_major(version), "source": source}
+    cache[binary] = {"mtime": mtime, "info": info}
+    _write_atomic(cache_file, json.dumps(cache, indent=2).encode("utf-8"))
+    return info
 
-        if match:
-            logging.debug("Found a match")
-            if match.group() == b'1.8':
-                logging.info("Found Java version 8, continuing.")
-                return True
-            else:
-                logging.info("Did not detect Java Version 8, please install Java 8 before continuing.")
-                return False
-        else:
-            logging.info("Java could not be detected on this system, please install Java 8 before continuing.")
-            return False
 
-    except:
-        logging.info("Warning: Java was not found in your path. Please ensure that Java 8 is configured correctly otherwise launching the gateway will fail")
+def spark_java_supported(spark_version):
+    minor = ".".join(spark_version.split(".")[:2])
+    return SPARK_JAVA_COMPATIBILITY.get(minor, SPARK_JAVA_COMPATIBILITY.get(spark_version.split(".")[0]))
+
+
+def _verify_java(spark_versions=None):
+    info = spark_java_info()
+    if info is None:
+        logging.info("Warning: Java was not found in your path. Please ensure that Java is configured correctly otherwise launching the gateway will fail")
         return False
+    logging.debug("Found Java %s at %s (from %s)" % (info["version"], info["path"], info["source"]))
+
+    for spark_version in spark_versions or []:
+        supported = spark_java_supported(spark_version)
+        if supported is None:
+            logging.info("No known Java requirements for Spark %s, continuing with Java %s." % (spark_version, info["major"]))
+        elif info["major"] not in supported:
+            logging.info("Spark %s requires Java %s but Java %s was found, please install a supported Java before continuing." %
+                         (spark_version, " or ".join(str(v) for v in supported), info["major"]))
+            return False
+    logging.info("Found Java version %s, continuing." % info["major"])
+    return True
+
 
+class SparkInstallCancelled(Exception):
+    pass
 
-def _file_age_days(jsonfile):
-    from datetime import datetime
-    ctime = os.stat(jsonfile).st_ctime
-    return (datetime.fromtimestamp(ctime) - datetime.now()).days
+
+def _check_cancel(cancel):
+    # cancel is a threading.Event set by the caller, checked between blocks and archive members
+    if cancel is not None and cancel.is_set():
+        raise SparkInstallCancelled("Installation cancelled")
 
 
 def _combine_versions(spark_version, hadoop_version):
     return spark_version + " " + hadoop_version
 
 
-def _download_file(url, local_file):
+def _replace_file(source, target):
+    try:
+        os.replace(source, target)
+    except AttributeError:
+        if os.path.exists(target):
+            os.remove(target)
+        os.rename(source, target)
+
+
+def _urlopen(url, headers=None, timeout=None):
+    try:
+        from urllib2 import urlopen, Request
+    except ImportError:
+        from urllib.request import urlopen, Request
+    return urlopen(Request(url, headers=headers or {}), timeout=timeout or DOWNLOAD_TIMEOUT)
+
+
+def _download_probe(url):
+    # A one byte ranged request tells us both the size and whether the server honors ranges
+    response = _urlopen(url, {"Range": "bytes=0-0"})
+    match = re.match(r"bytes 0-0/(\d+)$", response.info().get("Content-Range") or "")
+    if response.getcode() == 206 and match:
+        response.close()
+        return int(match.group(1)), None
+    length = response.info().get("Content-Length")
+    return (int(length) if length else None), response
+
+
+def _download_state_load(state_file, url, size, chunk_size):
+    # The url is informational only: chunks fetched from one mirror are kept when resuming from another
+    import json
+    state = {"url": url, "size": size, "chunk_size": chunk_size, "done": []}
+    if os.path.isfile(state_file):
+        try:
+            with open(state_file) as sf:
+                saved = json.load(sf)
+            if all(saved.get(k) == state[k] for k in ("size", "chunk_size")):
+                state["done"] = saved["done"]
+        except (IOError, ValueError, KeyError):
+            logging.debug("Ignoring unreadable download state %s" % state_file)
+    return state
+
+
+def _download_state_save(state_file, state):
+    import json
+    with open(state_file + ".tmp", "w") as sf:
+        json.dump(state, sf)
+    _replace_file(state_file + ".tmp", state_file)
+
+
+def _download_stream(response, part_file, hashers, size=None, progress=None, cancel=None):
+    done = 0
+    with open(part_file, "wb") as pf:
+        while True:
+            _check_cancel(cancel)
+            block = response.read(DOWNLOAD_BLOCK_SIZE)
+            if not block:
+                break
+            pf.write(block)
+            for hasher in hashers.values():
+                hasher.update(block)
+            if progress and (done + len(block)) // DOWNLOAD_CHUNK_SIZE != done // DOWNLOAD_CHUNK_SIZE:
+                progress(done + len(block), size)
+            done += len(block)
+    if progress:
+        progress(done, size)
+
+
+def _download_chunk(url, part_file, start, end, size, cancel=None):
+    response = _urlopen(url, {"Range": "bytes=%d-%d" % (start, end)})
+    try:
+        match = re.match(r"bytes \d+-\d+/(\d+)$", response.info().get("Content-Range") or "")
+        if response.getcode() != 206:
+            raise IOError("Server ignored range request for %s" % url)
+        if match and int(match.group(1)) != size:
+            raise IOError("%s has %s bytes instead of %d" % (url, match.group(1), size))
+        offset = start
+        with open(part_file, "r+b") as pf:
+            pf.seek(start)
+            while True:
+                _check_cancel(cancel)
+                block = response.read(DOWNLOAD_BLOCK_SIZE)
+                if not block:
+                    break
+                pf.write(block)
+                offset += len(block)
+    finally:
+        response.close()
+    if offset != end + 1:
+        raise IOError("Incomplete chunk %d-%d of %s" % (start, end, url))
+
+
+def _download_ranged(urls, part_file, state_file, size, threads, chunk_size, hashers, progress=None, cancel=None):
+    # urls lists the same file on several mirrors, best first. A chunk that keeps failing moves
+    # every later chunk to the next mirror while the chunks already on disk are kept.
+    from multiprocessing.pool import ThreadPool
+
+    url = urls[0]
+    mirror = [0]
+    mirror_lock = threading.Lock()
+    state = _download_state_load(state_file, url, size, chunk_size)
+    if not os.path.isfile(part_file) or os.path.getsize(part_file) != size:
+        state["done"] = []
+        with open(part_file, "wb") as pf:
+            pf.truncate(size)
+
+    chunk_count = (size + chunk_size - 1) // chunk_size
+    pending = [i for i in range(chunk_count) if i not in set(state["done"])]
+    if len(pending) < chunk_count:
+        logging.info("Resuming download of %s, %d of %d chunks remaining" % (url, len(pending), chunk_count))
+    state_lock = threading.Lock()
+    hash_lock = threading.Lock()
+    hashed = [0]
+
+    def advance_hash():
+        # Chunks finish out of order, so hash the contiguous prefix while it is still in the page cache
+        with hash_lock:
+            done = set(state["done"])
+            while hashed[0] in done:
+                with open(part_file, "rb") as pf:
+                    pf.seek(hashed[0] * chunk_size)
+                    data = pf.read(chunk_size)
+                for hasher in hashers.values():
+                    hasher.update(data)
+                hashed[0] += 1
+
+    def fetch(index):
+        start = index * chunk_size
+        end = min(start + chunk_size, size) - 1
+        attempt = 0
+        while True:
+            current = mirror[0]
+            try:
+                _download_chunk(urls[current], part_file, start, end, size, cancel)
+                break
+            except SparkInstallCancelled:
+                raise
+            except Exception as e:
+                attempt += 1
+                logging.debug("Chunk %d of %s failed (attempt %d): %s" % (index, urls[current], attempt, e))
+                if attempt < DOWNLOAD_RETRIES:
+                    continue
+                with mirror_lock:
+                    if mirror[0] == current and current + 1 < len(urls):
+                        logging.warning("Switching from %s to %s" % (urls[current], urls[current + 1]))
+                        _mirrors_demote(urls[current])
+                        mirror[0] = current + 1
+                if mirror[0] == current:
+                    raise
+                attempt = 0
+        with state_lock:
+            state["done"].append(index)
+            _download_state_save(state_file, state)
+            if progress:
+                progress(min(len(state["done"]) * chunk_size, size), size)
+        advance_hash()
+
+    advance_hash()
+    pool = ThreadPool(max(1, min(threads, len(pending))))
+    try:
+        pool.map(fetch, pending, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    advance_hash()
+    if hashed[0] != chunk_count:
+        raise IOError("Incomplete download of %s" % url)
+
+
+def _digest_split(digest):
+    algorithm, _, value = digest.partition(":")
+    return algorithm.lower(), value.lower()
+
+
+def _digest_hashers(digest):
+    import hashlib
+    hashers = {"sha256": hashlib.sha256()}
+    if digest:
+        algorithm = _digest_split(digest)[0]
+        hashers[algorithm] = hashlib.new(algorithm)
+    return hashers
+
+
+def _digest_check(digest, digests, source):
+    if not digest:
+        return
+    algorithm, value = _digest_split(digest)
+    if digests.get(algorithm) != value:
+        raise IOError("Checksum mismatch for %s: expected %s, got %s:%s" % (source, digest, algorithm, digests.get(algorithm)))
+
+
+def _digest_record(local_file, digests):
+    import json
+    stat = os.stat(local_file)
+    with open(local_file + ".digest", "w") as df:
+        json.dump({"size": stat.st_size, "mtime": stat.st_mtime, "digests": digests}, df)
+
+
+def _digest_recorded(local_file):
+    import json
     try:
-        from urllib import urlretrieve
+        with open(local_file + ".digest") as df:
+            record = json.load(df)
+        stat = os.stat(local_file)
+        if record["size"] == stat.st_size and record["mtime"] == stat.st_mtime:
+            return record["digests"]
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    return {}
+
+
+def _archive_verified(local_file, digest):
+    # Trusts a previously recorded digest as long as the archive was not touched since
+    if not digest:
+        return True
+    algorithm, value = _digest_split(digest)
+    digests = _digest_recorded(local_file)
+    if algorithm not in digests:
+        digests[algorithm] = _file_digest(local_file, algorithm)
+        _digest_record(local_file, digests)
+    return digests[algorithm] == value
+
+
+class _TeeReader(object):
+    def __init__(self, source, tee=None, hashers=None, progress=None, cancel=None):
+        self.source = source
+        self.tee = tee
+        self.hashers = hashers or {}
+        self.progress = progress
+        self.cancel = cancel
+        self.bytes = 0
+
+    def read(self, size=-1):
+        _check_cancel(self.cancel)
+        block = self.source.read(size) if size is not None and size >= 0 else self.source.read()
+        if self.tee is not None:
+            self.tee.write(block)
+        for hasher in self.hashers.values():
+            hasher.update(block)
+        if self.progress and (self.bytes + len(block)) // DOWNLOAD_CHUNK_SIZE != self.bytes // DOWNLOAD_CHUNK_SIZE:
+            self.progress(self.bytes + len(block), None)
+        self.bytes += len(block)
+        return block
+
+
+def _extract_write(target, data, source=None, size=0):
+    with open(target, "wb") as f:
+        size = len(data) if data is not None else size
+        if size and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+            except OSError:
+                pass
+        if data is not None:
+            f.write(data)
+        else:
+            shutil.copyfileobj(source, f, DOWNLOAD_BLOCK_SIZE)
+
+
+def _extract_link(staging, target, member):
+    if member.issym():
+        try:
+            os.symlink(member.linkname, target)
+            return
+        except (AttributeError, NotImplementedError, OSError):
+            source = os.path.join(os.path.dirname(target), member.linkname)
+    else:
+        source = os.path.join(staging, member.linkname)
+        try:
+            os.link(source, target)
+            return
+        except (AttributeError, OSError):
+            pass
+    if os.path.isfile(source):
+        shutil.copyfile(source, target)
+
+
+def _extract_reusable(reuse, data, mode):
+    # Returns an installed file with the same content and mode as data, if reuse knows one
+    import hashlib
+    if not reuse:
+        return None
+    return reuse.get((hashlib.sha256(data).hexdigest(), mode & 0o7777))
+
+
+def _extract_finish(staging, spark_dir, files, dirs, links, before_commit=None, reused=(), merge=False):
+    # Links, then modes and mtimes in bulk, then the rename into spark_dir. Files linked
+    # from another version already have the right mode and are shared, so they are left alone.
+    for target, member in links:
+        _extract_link(staging, target, member)
+    for target, member in files:
+        if target in reused:
+            continue
+        os.chmod(target, member.mode & 0o7777)
+        os.utime(target, (member.mtime, member.mtime))
+    for target, member in sorted(dirs, key=lambda d: d[0], reverse=True):
+        os.chmod(target, member.mode & 0o7777)
+        os.utime(target, (member.mtime, member.mtime))
+
+    if before_commit:
+        before_commit()
+    for entry in os.listdir(staging):
+        if os.path.exists(os.path.join(spark_dir, entry)):
+            if merge:
+                _extract_merge(os.path.join(staging, entry), os.path.join(spark_dir, entry))
+                continue
+            logging.info("Keeping existing %s" % os.path.join(spark_dir, entry))
+            continue
+        os.rename(os.path.join(staging, entry), os.path.join(spark_dir, entry))
+
+
+def _extract_merge(source, target):
+    # Moves newly extracted members into an existing version directory
+    for root, dirs, files in os.walk(source):
+        destination = os.path.join(target, os.path.relpath(root, source))
+        for name in dirs:
+            if os.path.islink(os.path.join(root, name)):
+                files.append(name)
+            elif not os.path.isdir(os.path.join(destination, name)):
+                os.makedirs(os.path.join(destination, name))
+        for name in files:
+            if os.path.lexists(os.path.join(destination, name)):
+                os.remove(os.path.join(destination, name))
+            os.rename(os.path.join(root, name), os.path.join(destination, name))
+
+
+def _extract_target(staging, spark_dir, name):
+    path = os.path.normpath(name)
+    if os.path.isabs(path) or path == ".." or path.startswith(".." + os.sep):
+        raise IOError("Refusing to extract %s outside of %s" % (name, spark_dir))
+    return os.path.join(staging, path)
+
+
+def _extract_staging(spark_dir):
+    # A staging directory paired with a lock held for as long as it is in use, so that
+    # _extract_cleanup() can tell the leftovers of a crashed process from a running extraction
+    import tempfile
+    fd, lock_path = tempfile.mkstemp(prefix=".extract-", suffix=".lock", dir=spark_dir)
+    os.close(fd)
+    lock = _FileLock(lock_path, remove=True).__enter__()
+    staging = lock_path[:-len(".lock")]
+    os.mkdir(staging, 0o700)
+    return staging, lock
+
+
+def _extract_release(staging, lock):
+    shutil.rmtree(staging, ignore_errors=True)
+    lock.__exit__(None, None, None)
+
+
+def _extract_cleanup(spark_dir):
+    # Removes staging directories whose lock nobody holds. Taking the lock while removing keeps
+    # a new extraction that picked the same name from starting until the leftovers are gone.
+    names = set(name[:-len(".lock")] if name.endswith(".lock") else name for name in os.listdir(spark_dir))
+    for name in sorted(names):
+        if not name.startswith(".extract-"):
+            continue
+        staging = os.path.join(spark_dir, name)
+        try:
+            with _FileLock(staging + ".lock", timeout=0, remove=True):
+                logging.info("Removing %s left behind by an interrupted extraction" % staging)
+                shutil.rmtree(staging, ignore_errors=True)
+        except (IOError, OSError):
+            continue
+
+
+def _extract_archive(source, spark_dir, threads=None, before_commit=None, reuse=None, cancel=None, member_filter=None, merge=False):
+    # Decompresses on this thread and hands member writes to a pool. Everything lands in a
+    # staging directory that is renamed into spark_dir once complete, so a crash never
+    # leaves a half extracted spark_version_dir behind. reuse maps (sha256, mode) to files
+    # of an installed version that are linked instead of written when a member matches.
+    # Members rejected by member_filter are skipped, and with merge the rest are moved into
+    # an existing spark_version_dir.
+    import tarfile
+    from multiprocessing.pool import ThreadPool
+
+    staging, staging_lock = _extract_staging(spark_dir)
+    pool = ThreadPool(threads or EXTRACT_THREADS)
+    pending = threading.Condition()
+    pending_bytes = [0]
+    results = []
+    files, dirs, links = [], [], []
+    reused = set()
+
+    def write(target, data, mode):
+        try:
+            existing = _extract_reusable(reuse, data, mode)
+            if existing:
+                _link_file(existing, target)
+                reused.add(target)
+            else:
+                _extract_write(target, data)
+        finally:
+            with pending:
+                pending_bytes[0] -= len(data)
+                pending.notify_all()
+
+    try:
+        if hasattr(source, "read"):
+            tf = tarfile.open(fileobj=source, mode="r|*")
+        else:
+            tf = tarfile.open(source, mode="r|*")
+        with tf:
+            for member in tf:
+                _check_cancel(cancel)
+                if member_filter and not member_filter(member):
+                    continue
+                target = _extract_target(staging, spark_dir, member.name)
+                if member.isdir():
+                    if not os.path.isdir(target):
+                        os.makedirs(target)
+                    dirs.append((target, member))
+                    continue
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                if member.issym() or member.islnk():
+                    links.append((target, member))
+                elif member.isfile():
+                    files.append((target, member))
+                    if member.size > EXTRACT_MAX_PENDING:
+                        _extract_write(target, None, tf.extractfile(member), member.size)
+                        continue
+                    data = tf.extractfile(member).read()
+                    with pending:
+                        while pending_bytes[0] and pending_bytes[0] + len(data) > EXTRACT_MAX_PENDING:
+                            pending.wait()
+                        pending_bytes[0] += len(data)
+                    results.append(pool.apply_async(write, (target, data, member.mode)))
+        for result in results:
+            result.get()
+
+        _extract_finish(staging, spark_dir, files, dirs, links, before_commit, reused, merge)
+    finally:
+        pool.close()
+        pool.join()
+        _extract_release(staging, staging_lock)
+    return {"files": len(files), "reused": len(reused)}
+
+
+def _download_extract(url, target_dir, tee_file=None, digest=None, progress=None, reuse=None, stats=None, cancel=None,
+                      member_filter=None, merge=False):
+    # Pipes the response through gzip into tarfile's stream mode so members are
+    # extracted while the rest of the archive is still arriving
+    part_file = tee_file + ".part" if tee_file else None
+    hashers = _digest_hashers(digest)
+    response = _urlopen(url)
+    tee = open(part_file, "wb") if part_file else None
+    reader = _TeeReader(response, tee, hashers, progress, cancel)
+    digests = {}
+
+    def verify():
+        while reader.read(DOWNLOAD_BLOCK_SIZE):
+            pass
+        if progress:
+            progress(reader.bytes, reader.bytes)
+        digests.update((a, h.hexdigest()) for a, h in hashers.items())
+        _digest_check(digest, digests, url)
+
+    try:
+        extracted = _extract_archive(reader, target_dir, before_commit=verify, reuse=reuse, cancel=cancel,
+                                     member_filter=member_filter, merge=merge)
+        if stats is not None:
+            stats.update(extracted, fetched_bytes=reader.bytes)
+    except:
+        if tee is not None:
+            tee.close()
+            os.remove(part_file)
+        raise
+    finally:
+        response.close()
+        if tee is not None:
+            tee.close()
+    if part_file:
+        _replace_file(part_file, tee_file)
+    return digests
+
+
+def _download_file(url, local_file, threads=None, chunk_size=None, digest=None, progress=None, mirrors=None, cancel=None):
+    try:
+        return _download_file_from(url, local_file, threads, chunk_size, digest, progress, mirrors, cancel)
+    except SparkInstallCancelled:
+        for partial in (local_file + ".part", local_file + ".state"):
+            if os.path.isfile(partial):
+                os.remove(partial)
+        raise
+
+
+def _download_file_from(url, local_file, threads=None, chunk_size=None, digest=None, progress=None, mirrors=None, cancel=None):
+    part_file = local_file + ".part"
+    state_file = local_file + ".state"
+    urls = spark_mirrors_rank([url] + list(mirrors)) if mirrors else [url]
+    for i, url in enumerate(urls):
+        # Ranged downloads fail over chunk by chunk, single streams start over on the next mirror
+        hashers = _digest_hashers(digest)
+        try:
+            size, response = _download_probe(url)
+            if response is not None:
+                logging.debug("Server does not support ranges, downloading %s as a single stream" % url)
+                try:
+                    _download_stream(response, part_file, hashers, size, progress, cancel)
+                finally:
+                    response.close()
+                if size is not None and os.path.getsize(part_file) != size:
+                    raise IOError("Incomplete download of %s" % url)
+        except SparkInstallCancelled:
+            raise
+        except Exception as e:
+            if i + 1 == len(urls):
+                raise
+            logging.warning("Download from %s failed, trying %s: %s" % (url, urls[i + 1], e))
+            _mirrors_demote(url)
+            continue
+        if response is None:
+            _download_ranged(urls[i:], part_file, state_file, size,
+                             threads or DOWNLOAD_THREADS, chunk_size or DOWNLOAD_CHUNK_SIZE, hashers, progress, cancel)
+        break
+    if os.path.isfile(state_file):
+        os.remove(state_file)
+    digests = dict((a, h.hexdigest()) for a, h in hashers.items())
+    try:
+        _digest_check(digest, digests, url)
+    except IOError:
+        os.remove(part_file)
+        raise
+    _replace_file(part_file, local_file)
+    return digests
+
+
+def _spark_global_mirrors():
+    mirrors = os.getenv("SPARK_INSTALL_MIRRORS")
+    if mirrors is None:
+        return list(SPARK_MIRRORS)
+    return [m.strip() for m in mirrors.split(",") if m.strip()]
+
+
+def _mirror_host(url):
+    try:
+        from urlparse import urlparse
     except ImportError:
-        from urllib.request import urlretrieve
-    urlretrieve(url, local_file)
+        from urllib.parse import urlparse
+    parsed = urlparse(url)
+    return "%s://%s" % (parsed.scheme, parsed.netloc)
+
+
+_mirrors_lock = threading.Lock()
+
+
+def _mirrors_update(update):
+    # Rankings are kept per host in <install_dir>/.mirrors.json
+    import json
+    mirrors_file = os.path.join(spark_install_dir(), ".mirrors.json")
+    with _mirrors_lock:
+        try:
+            with open(mirrors_file) as f:
+                mirrors = json.load(f)
+        except (IOError, OSError, ValueError):
+            mirrors = {}
+        if update:
+            mirrors.update(update)
+            if not os.path.isdir(os.path.dirname(mirrors_file)):
+                os.makedirs(os.path.dirname(mirrors_file))
+            _write_atomic(mirrors_file, json.dumps(mirrors, indent=2, sort_keys=True).encode("utf-8"))
+    return mirrors
+
+
+def _mirrors_demote(url):
+    import time
+    _mirrors_update({_mirror_host(url): {"failed": True, "checked": time.time()}})
+
+
+def _mirror_probe(url):
+    # Time to fetch the first MIRROR_PROBE_SIZE bytes covers both latency and throughput. A host
+    # ignoring the Range header sends the whole file, so reading stops after that many bytes.
+    import time
+    started = time.time()
+    try:
+        response = _urlopen(url, {"Range": "bytes=0-%d" % (MIRROR_PROBE_SIZE - 1)}, MIRROR_PROBE_TIMEOUT)
+        try:
+            remaining = MIRROR_PROBE_SIZE
+            while remaining > 0:
+                block = response.read(min(DOWNLOAD_BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+        finally:
+            response.close()
+    except Exception as e:
+        logging.debug("Probing %s failed: %s" % (url, e))
+        return {"failed": True, "checked": time.time()}
+    return {"seconds": time.time() - started, "checked": time.time()}
+
+
+def spark_mirrors_rank(urls):
+    # Orders urls for the same file from the fastest to the slowest host, probing hosts that
+    # have not been measured within MIRRORS_TTL_HOURS concurrently. Failed hosts go last.
+    import time
+    from multiprocessing.pool import ThreadPool
+    urls = [u for i, u in enumerate(urls) if u not in urls[:i]]
+    if len(urls) < 2:
+        return urls
+    known = _mirrors_update(None)
+    stale = [u for u in urls if time.time() - known.get(_mirror_host(u), {}).get("checked", 0) > MIRRORS_TTL_HOURS * 3600]
+    if stale:
+        pool = ThreadPool(len(stale))
+        try:
+            probes = pool.map(_mirror_probe, stale)
+        finally:
+            pool.close()
+            pool.join()
+        known = _mirrors_update(dict((_mirror_host(u), p) for u, p in zip(stale, probes)))
+
+    def rank(url):
+        entry = known.get(_mirror_host(url), {})
+        return (bool(entry.get("failed")), entry.get("seconds", float("inf")))
+    ranked = sorted(urls, key=rank)
+    logging.debug("Mirrors ranked: %s" % ", ".join(ranked))
+    return ranked
+
+
+class _FileLock(object):
+    # Exclusive lock on path. With a timeout the lock is polled and IOError raised once it runs
+    # out. With remove the file is deleted on release, so its existence means an install is in
+    # progress; a lock left behind by a crashed process is no longer locked and is simply taken over.
+    def __init__(self, path, timeout=None, remove=False):
+        self.path = path
+        self.timeout = timeout
+        self.remove = remove
+        self.fd = None
+
+    def _lock(self, blocking):
+        try:
+            import fcntl
+        except ImportError:
+            import msvcrt
+            while True:
+                try:
+                    msvcrt.locking(self.fd, msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+                    return True
+                except (IOError, OSError):
+                    # LK_LOCK gives up after ten seconds, keep waiting
+                    if not blocking:
+                        return False
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except (IOError, OSError) as e:
+            import errno
+            if blocking or e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+
+    def _unlock(self):
+        try:
+            import fcntl
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        except ImportError:
+            import msvcrt
+            os.lseek(self.fd, 0, 0)
+            msvcrt.locking(self.fd, msvcrt.LK_UNLCK, 1)
+
+    def held(self):
+        # True when another process or thread currently holds the lock
+        try:
+            self.fd = os.open(self.path, os.O_RDONLY)
+        except (IOError, OSError):
+            return False
+        try:
+            if self._lock(False):
+                self._unlock()
+                return False
+            return True
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
+    def acquire(self, blocking=True):
+        # Takes the lock; without blocking, returns False right away when someone else holds it
+        while True:
+            # flock needs no write access, so a lock file created by another user still works
+            self.fd = os.open(self.path, (os.O_RDWR if self.remove else os.O_RDONLY) | os.O_CREAT, 0o666)
+            if not self._lock(blocking):
+                os.close(self.fd)
+                self.fd = None
+                return False
+            try:
+                current = os.stat(self.path).st_ino
+            except OSError:
+                current = None
+            # The previous holder may have removed the file between our open and lock
+            if not self.remove or current == os.fstat(self.fd).st_ino:
+                break
+            self._unlock()
+            os.close(self.fd)
+        if self.remove:
+            os.ftruncate(self.fd, 0)
+            os.write(self.fd, ("%d\n" % os.getpid()).encode("utf-8"))
+        return True
+
+    def __enter__(self):
+        import time
+        if self.timeout is None:
+            self.acquire()
+            return self
+        deadline = time.time() + self.timeout
+        while not self.acquire(False):
+            if time.time() >= deadline:
+                raise IOError("Timed out waiting for %s" % self.path)
+            time.sleep(0.1)
+        return self
+
+    def __exit__(self, *args):
+        if self.remove:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        self._unlock()
+        os.close(self.fd)
+        self.fd = None
+
+
+def _file_digest(path, algorithm="sha256"):
+    import hashlib
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(DOWNLOAD_BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _reflink_file(source, target):
+    import fcntl
+    FICLONE = 0x40049409
+    with open(source, "rb") as src:
+        with open(target, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def _link_file(source, target):
+    # Hardlink when possible, then reflink, and only copy as a last resort
+    temp = "%s.%d.tmp" % (target, os.getpid())
+    try:
+        os.link(source, temp)
+    except (AttributeError, OSError):
+        try:
+            _reflink_file(source, temp)
+        except (ImportError, IOError, OSError):
+            shutil.copyfile(source, temp)
+    _replace_file(temp, target)
 
 
 def spark_can_install():
@@ -60,67 +944,236 @@ def spark_can_install():
         os.makedirs(install_dir)
 
 
-def spark_versions_initialize(connecting=False):
+class _VersionCatalog(object):
+    # Loads versions.json once and keeps dict indexes over it. The catalog and the installed
+    # versions are reloaded only when the mtime of versions.json or of the install directory moves.
+
+    def __init__(self):
+        self.versions_stamp = None
+        self.versions_checked = 0
+        self.installed_stamp = None
+        self.versions = []
+        self.by_pair = {}
+        self.by_spark = {}
+        self.by_hadoop = {}
+        self.installed = []
+        self.installed_pairs = set()
+
+    @staticmethod
+    def _stamp(jsonfile):
+        try:
+            stat = os.stat(jsonfile)
+        except OSError:
+            return None
+        return (jsonfile, stat.st_mtime, stat.st_size)
+
+    def load_versions(self, connecting=False):
+        import json
+        import time
+        # The TTL is only looked at again when versions.json changed, on connecting calls or once
+        # it ran out since the last check, so a lookup costs a single stat
+        jsonfile = os.path.join(spark_install_dir(), "versions.json")
+        stamp = self._stamp(jsonfile)
+        if connecting or stamp != self.versions_stamp or time.time() - self.versions_checked > _spark_versions_ttl():
+            jsonfile, self.versions_checked = _spark_versions_file(connecting)
+            stamp = self._stamp(jsonfile)
+        if stamp != self.versions_stamp:
+            with open(jsonfile) as jf:
+                versions = json.load(jf)
+            self.by_pair, self.by_spark, self.by_hadoop = {}, {}, {}
+            for v in versions:
+                self.by_pair.setdefault((v["spark"], v["hadoop"]), v)
+                self.by_spark.setdefault(v["spark"], []).append(v)
+                self.by_hadoop.setdefault(v["hadoop"], []).append(v)
+            self.versions = versions
+            self.versions_stamp = stamp
+        return self.versions
+
+    def load_installed(self):
+        base_dir = spark_install_dir()
+        stamp = (base_dir, os.stat(base_dir).st_mtime)
+        if stamp != self.installed_stamp:
+            self.installed = _spark_installed_scan(base_dir)
+            self.installed_pairs = set((v["spark"], v["hadoop"]) for v in self.installed)
+            self.installed_stamp = stamp
+        return self.installed
+
+    def lookup(self, spark_version, hadoop_version):
+        self.load_versions()
+        return self.by_pair.get((spark_version, hadoop_version))
+
+    def find(self, spark_version=None, hadoop_version=None, installed_only=True, connecting=False):
+        self.load_versions(connecting)
+        if spark_version and hadoop_version:
+            pair = (spark_version, hadoop_version)
+            versions = [self.by_pair[pair]] if pair in self.by_pair else []
+        elif spark_version:
+            versions = self.by_spark.get(spark_version, [])
+        elif hadoop_version:
+            versions = self.by_hadoop.get(hadoop_version, [])
+        else:
+            versions = self.versions
+        if installed_only:
+            self.load_installed()
+            versions = [v for v in versions if (v["spark"], v["hadoop"]) in self.installed_pairs]
+        return versions
+
+
+_catalog = _VersionCatalog()
+
+
+def _write_atomic(path, data, mode=0o644):
+    # A uniquely named temp file keeps concurrent writers from clobbering each other's partial output
+    import tempfile
+    fd, temp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(temp, mode)
+        _replace_file(temp, path)
+    except:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def _versions_meta_load(jsonfile):
+    import json
+    try:
+        with open(jsonfile + ".meta") as mf:
+            return json.load(mf)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _versions_meta_save(jsonfile, meta):
     import json
+    _write_atomic(jsonfile + ".meta", json.dumps(meta).encode("utf-8"))
+
+
+def _spark_versions_refresh(jsonfile, meta):
+    import json
+    import time
+    headers = {}
+    if os.path.isfile(jsonfile):
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    logging.info("Refreshing %s from %s" % (jsonfile, SPARK_VERSIONS_URL))
+    try:
+        response = _urlopen(SPARK_VERSIONS_URL, headers)
+        try:
+            data = response.read()
+            etag = response.info().get("ETag")
+            last_modified = response.info().get("Last-Modified")
+        finally:
+            response.close()
+        json.loads(data.decode("utf-8"))
+    except (IOError, OSError, ValueError) as e:
+        if getattr(e, "code", None) == 304:
+            logging.debug("%s is up to date" % jsonfile)
+            meta["checked"] = time.time()
+            _versions_meta_save(jsonfile, meta)
+            return
+        if not os.path.isfile(jsonfile):
+            raise
+        logging.warning("Could not refresh %s, using the local copy: %s" % (jsonfile, e))
+        return
+
+    _write_atomic(jsonfile, data)
+    _versions_meta_save(jsonfile, {"etag": etag, "last_modified": last_modified, "checked": time.time()})
+
+
+def _spark_versions_ttl():
+    return float(os.getenv("SPARK_VERSIONS_TTL_DAYS", VERSIONS_TTL_DAYS)) * 24 * 60 * 60
+
+
+def _spark_versions_file(connecting=False):
+    # Revalidates with a conditional request once the TTL has passed, or on every connecting call.
+    # Returns the file and when it was last checked; a failed refresh counts as a check, so an
+    # offline process doesn't retry on every lookup.
+    import time
     spark_can_install()
     jsonfile = os.path.join(spark_install_dir(), "versions.json")
-    if not os.path.isfile(jsonfile) or _file_age_days(jsonfile) > 30 or connecting:
-        logging.info("Downloading %s to %s" % (SPARK_VERSIONS_URL, jsonfile))
-        _download_file(SPARK_VERSIONS_URL, jsonfile)
-    with open(jsonfile) as jf:
-        return json.load(jf)
+    if os.path.isfile(jsonfile):
+        meta = _versions_meta_load(jsonfile)
+        checked = meta.get("checked", os.stat(jsonfile).st_mtime)
+        if connecting or time.time() - checked > _spark_versions_ttl():
+            _spark_versions_refresh(jsonfile, meta)
+            checked = time.time()
+    else:
+        _spark_versions_refresh(jsonfile, {})
+        checked = time.time()
+    return jsonfile, checked
+
+
+def spark_versions_initialize(connecting=False):
+    return [dict(v) for v in _catalog.load_versions(connecting)]
 
 def spark_versions(connecting=False):
-    versions = spark_versions_initialize(connecting)
-    installed = set([_combine_versions(v["spark"], v["hadoop"]) for v in spark_installed_versions()])
-    for v in versions: v["installed"] = _combine_versions(v["spark"], v["hadoop"]) in installed
-    return versions
+    versions = _catalog.load_versions(connecting)
+    _catalog.load_installed()
+    return [dict(v, installed=(v["spark"], v["hadoop"]) in _catalog.installed_pairs) for v in versions]
 
 
 def spark_versions_info(spark_version, hadoop_version):
-    versions = [v for v in spark_versions() if v["spark"] == spark_version and v["hadoop"] == hadoop_version]
+    version = _catalog.lookup(spark_version, hadoop_version)
 
-    if versions == []:
+    if version is None:
         raise ValueError("Unable to find Spark version: %s and Hadoop version: %s" % (spark_version, hadoop_version))
 
-    package_name = versions[0]["pattern"]%(spark_version, hadoop_version)
+    package_name = version["pattern"]%(spark_version, hadoop_version)
     component_name = os.path.splitext(package_name)[0]
-    package_remote_path = versions[0]["base"] + package_name
+    package_remote_path = version["base"] + package_name
+
+    mirrors = []
+    for base in version.get("mirrors", []) + _spark_global_mirrors():
+        remote = base.format(spark=spark_version, hadoop=hadoop_version) + package_name
+        if remote != package_remote_path and remote not in mirrors:
+            mirrors.append(remote)
 
     return {"component_name": component_name,
             "package_name": package_name,
-            "package_remote_path": package_remote_path}
+            "package_remote_path": package_remote_path,
+            "mirrors": mirrors,
+            "digest": version.get("digest")}
 
 
-def spark_installed_versions():
-    base_dir = spark_install_dir()
+def _spark_install_lock(spark_version_dir):
+    spark_dir, component = os.path.split(spark_version_dir)
+    return _FileLock(os.path.join(spark_dir, ".%s.lock" % component), INSTALL_LOCK_TIMEOUT, remove=True)
+
+
+def _spark_installed_scan(base_dir):
+    # Versions still being installed by another process hold their lock and are left out
     versions = []
     for candidate in os.listdir(base_dir):
         match = re.match(SPARK_VERSIONS_FILE_PATTERN, candidate)
         fullpath = os.path.join(base_dir, candidate)
         if os.path.isdir(fullpath) and match:
+            if os.path.exists(os.path.join(base_dir, ".%s.lock" % candidate)) and _spark_install_lock(fullpath).held():
+                continue
             versions.append({"spark": match.group(1), "hadoop": match.group(2), "dir": fullpath})
     return versions
 
 
+def spark_installed_versions():
+    return [dict(v) for v in _catalog.load_installed()]
+
+
 def spark_install_available(spark_version, hadoop_version):
     info = spark_install_info(spark_version, hadoop_version)
     return os.path.isdir(info["spark_version_dir"])
 
 
 def spark_install_find(spark_version=None, hadoop_version=None, installed_only=True, connecting=False):
-    versions = spark_versions(connecting)
-    if installed_only:
-        versions = filter(lambda v: v["installed"], versions)
-    if spark_version:
-        versions = filter(lambda v: v["spark"] == spark_version, versions)
-    if hadoop_version:
-        versions = filter(lambda v: v["hadoop"] == hadoop_version, versions)
-    versions = list(versions)
+    versions = _catalog.find(spark_version, hadoop_version, installed_only, connecting)
 
     if versions == []:
         logging.critical("Please select an available version pair for Spark and Hadoop from the following list: ")
-        available_versions = spark_versions_initialize(connecting)
+        available_versions = _catalog.versions
         sep = "+" + "-"*18 + "+"
         fmt = "|{:>8}| {:>8}|"
         logging.critical(NL + NL.join([sep] + 
@@ -130,14 +1183,14 @@ def spark_install_find(spark_version=None, hadoop_version=None, installed_only=T
                                  [sep]))
         raise RuntimeError("Unrecognized combination of Spark/Hadoop versions: (%s, %s). Please select a valid pair of Spark and Hadoop versions to download."%(spark_version, hadoop_version))
 
-    candidate = sorted(versions, key=lambda rec: _combine_versions(rec["spark"], rec["hadoop"]))[-1]
+    candidate = max(versions, key=lambda rec: _combine_versions(rec["spark"], rec["hadoop"]))
     return spark_install_info(candidate["spark"], candidate["hadoop"])
 
 def spark_default_version():
-    if len(spark_installed_versions()) > 0:
+    if len(_catalog.load_installed()) > 0:
         version = spark_install_find()
     else:
-        version = sorted(spark_versions_initialize(), key=lambda rec: _combine_versions(rec["spark"], rec["hadoop"]))[-1]
+        version = max(_catalog.load_versions(), key=lambda rec: _combine_versions(rec["spark"], rec["hadoop"]))
     return {"spark": version["spark"], "hadoop": version["hadoop"]}
 
 def spark_install_info(spark_version, hadoop_version):
@@ -151,8 +1204,11 @@ def spark_install_info(spark_version, hadoop_version):
     spark_version_dir = os.path.join(spark_dir, component_name)
 
     return {"spark_dir": spark_dir,
+            "package_name": package_name,
             "package_local_path": os.path.join(spark_dir, package_name),
             "package_remote_path": package_remote_path,
+            "package_mirrors": info["mirrors"],
+            "digest": info["digest"],
             "spark_version_dir": spark_version_dir,
             "spark_conf_dir": os.path.join(spark_version_dir, "conf"),
             "spark": spark_version,
@@ -164,8 +1220,12 @@ def spark_uninstall(spark_version, hadoop_version):
     logging.debug("Inside uninstall routine.")
     info = spark_versions_info(spark_version, hadoop_version)
     spark_dir = os.path.join(spark_install_dir(), info["component_name"])
-    shutil.rmtree(spark_dir, ignore_errors=True)
+    if os.path.isdir(spark_dir):
+        with _spark_install_lock(spark_dir):
+            shutil.rmtree(spark_dir, ignore_errors=True)
     logging.debug("File tree removed.")
+    _extract_cleanup(spark_install_dir())
+    spark_dedup_gc()
 
 
 def spark_install_dir():
@@ -173,62 +1233,520 @@ def spark_install_dir():
     return os.getenv("SPARK_INSTALL_DIR", os.path.join(homedir, "spark"))
 
 
-def spark_conf_log4j_set_value(install_info, properties, reset):
-    log4jproperties_file = os.path.join(install_info["spark_conf_dir"], "log4j.properties")
-    if not os.path.isfile(log4jproperties_file) or reset:
-        template = os.path.join(install_info["spark_conf_dir"], "log4j.properties.template")
-        shutil.copyfile(template, log4jproperties_file)
-
-    with open(log4jproperties_file, "r") as infile:
-        lines = infile.readlines()
-        for i in range(len(lines)):
-            if lines[i].startswith("#") or "=" not in lines[i]:
+def spark_cache_dir():
+    return os.getenv("SPARK_INSTALL_CACHE_DIR")
+
+
+def _cache_index_load(cache_dir):
+    import json
+    index_file = os.path.join(cache_dir, "index.json")
+    if not os.path.isfile(index_file):
+        return {"names": {}, "objects": {}}
+    with open(index_file) as f:
+        return json.load(f)
+
+
+def _cache_index_save(cache_dir, index):
+    import json
+    _write_atomic(os.path.join(cache_dir, "index.json"), json.dumps(index, indent=2, sort_keys=True).encode("utf-8"), CACHE_FILE_MODE)
+
+
+def _cache_object_path(cache_dir, digest):
+    return os.path.join(cache_dir, "objects", digest[:2], digest)
+
+
+def _cache_makedirs(path):
+    # Directories are made group writable and setgid regardless of the umask so that other
+    # users can add and evict objects
+    missing = []
+    while not os.path.isdir(path):
+        missing.append(path)
+        path = os.path.dirname(path)
+    for path in reversed(missing):
+        try:
+            os.mkdir(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+            continue
+        os.chmod(path, CACHE_DIR_MODE)
+
+
+def _cache_open(cache_dir):
+    _cache_makedirs(os.path.join(cache_dir, "objects"))
+    lock_file = os.path.join(cache_dir, ".lock")
+    if not os.path.exists(lock_file):
+        try:
+            open(lock_file, "a").close()
+            os.chmod(lock_file, CACHE_FILE_MODE)
+        except (IOError, OSError):
+            pass
+    return _FileLock(lock_file)
+
+
+def spark_cache_get(name, local_path, cache_dir=None):
+    import time
+    cache_dir = cache_dir or spark_cache_dir()
+    if not cache_dir:
+        return None
+    with _cache_open(cache_dir):
+        index = _cache_index_load(cache_dir)
+        digest = index["names"].get(name)
+        if not digest or not os.path.isfile(_cache_object_path(cache_dir, digest)):
+            return None
+        _link_file(_cache_object_path(cache_dir, digest), local_path)
+        index["objects"][digest]["used"] = time.time()
+        _cache_index_save(cache_dir, index)
+    logging.info("Using cached %s from %s" % (name, cache_dir))
+    return digest
+
+
+def spark_cache_put(name, local_path, cache_dir=None, max_size=None, digest=None):
+    import time
+    cache_dir = cache_dir or spark_cache_dir()
+    if not cache_dir:
+        return None
+    digest = digest or _file_digest(local_path)
+    with _cache_open(cache_dir):
+        index = _cache_index_load(cache_dir)
+        object_path = _cache_object_path(cache_dir, digest)
+        if not os.path.isfile(object_path):
+            _cache_makedirs(os.path.dirname(object_path))
+            _link_file(local_path, object_path)
+        index["names"][name] = digest
+        index["objects"][digest] = {"size": os.path.getsize(object_path), "used": time.time()}
+        _cache_evict(cache_dir, index, max_size)
+        _cache_index_save(cache_dir, index)
+    return digest
+
+
+def _cache_evict(cache_dir, index, max_size):
+    max_size = max_size or int(os.getenv("SPARK_INSTALL_CACHE_SIZE", CACHE_MAX_SIZE))
+    total = sum(o["size"] for o in index["objects"].values())
+    for digest in sorted(index["objects"], key=lambda d: index["objects"][d]["used"]):
+        if total <= max_size:
+            break
+        logging.info("Evicting %s from the archive cache" % digest)
+        total -= index["objects"].pop(digest)["size"]
+        try:
+            os.remove(_cache_object_path(cache_dir, digest))
+        except OSError:
+            pass
+        for name in [n for n, d in index["names"].items() if d == digest]:
+            del index["names"][name]
+
+
+def spark_cache_evict(max_size=None, cache_dir=None):
+    cache_dir = cache_dir or spark_cache_dir()
+    if not cache_dir:
+        return
+    with _cache_open(cache_dir):
+        index = _cache_index_load(cache_dir)
+        _cache_evict(cache_dir, index, max_size)
+        _cache_index_save(cache_dir, index)
+
+
+def _dedup_store():
+    return os.path.join(spark_install_dir(), ".objects")
+
+
+def spark_dedup(spark_version_dirs=None, min_size=DEDUP_MIN_SIZE):
+    # Replaces files that are byte-identical across installed versions with hardlinks into a
+    # shared object store. The link count of each stored object doubles as its reference count.
+    # conf/ is skipped since it holds the files we rewrite per version.
+    import stat
+    if spark_version_dirs is None:
+        spark_version_dirs = [v["dir"] for v in spark_installed_versions()]
+    store = _dedup_store()
+    if not os.path.isdir(store):
+        os.makedirs(store)
+
+    stats = {"files": 0, "linked": 0, "saved_bytes": 0}
+    with _FileLock(os.path.join(store, ".lock")):
+        for version_dir in spark_version_dirs:
+            for root, dirs, files in os.walk(version_dir):
+                if root == version_dir and "conf" in dirs:
+                    dirs.remove("conf")
+                for name in files:
+                    path = os.path.join(root, name)
+                    st = os.lstat(path)
+                    if not stat.S_ISREG(st.st_mode) or st.st_size < min_size or st.st_nlink > 1:
+                        continue
+                    stats["files"] += 1
+                    digest = _file_digest(path)
+                    blob = os.path.join(store, digest[:2], "%s-%o" % (digest, stat.S_IMODE(st.st_mode)))
+                    if not os.path.isfile(blob):
+                        if not os.path.isdir(os.path.dirname(blob)):
+                            os.makedirs(os.path.dirname(blob))
+                        os.link(path, blob)
+                        continue
+                    temp = "%s.%d.tmp" % (path, os.getpid())
+                    os.link(blob, temp)
+                    _replace_file(temp, path)
+                    stats["linked"] += 1
+                    stats["saved_bytes"] += st.st_size
+    logging.info("Deduplicated %d of %d files, saving %d bytes" % (stats["linked"], stats["files"], stats["saved_bytes"]))
+    return stats
+
+
+def spark_dedup_gc():
+    # Objects whose only remaining link is the store itself are no longer used by any version
+    store = _dedup_store()
+    if not os.path.isdir(store):
+        return 0
+    removed = 0
+    with _FileLock(os.path.join(store, ".lock")):
+        for root, dirs, files in os.walk(store):
+            for name in files:
+                path = os.path.join(root, name)
+                if name != ".lock" and os.lstat(path).st_nlink == 1:
+                    os.remove(path)
+                    removed += 1
+    logging.debug("Removed %d unused objects from %s" % (removed, store))
+    return removed
+
+
+_MANIFEST_TYPES = {"file": b"0", "link": b"1", "symlink": b"2", "dir": b"5"}
+
+
+def _manifest_entry(member, offset=None, sha256=None):
+    kind = "dir" if member.isdir() else "symlink" if member.issym() else "link" if member.islnk() else "file"
+    entry = {"name": member.name, "type": kind, "mode": member.mode & 0o7777, "mtime": member.mtime}
+    if kind == "file":
+        entry.update(size=member.size, sha256=sha256, offset=offset)
+    elif kind != "dir":
+        entry["linkname"] = member.linkname
+    return entry
+
+
+def _manifest_tarinfo(entry):
+    import tarfile
+    member = tarfile.TarInfo(entry["name"])
+    member.type = _MANIFEST_TYPES[entry["type"]]
+    member.mode = entry["mode"]
+    member.mtime = entry["mtime"]
+    member.size = entry.get("size", 0)
+    member.linkname = entry.get("linkname", "")
+    return member
+
+
+def spark_archive_manifest(archive_path, write=True):
+    # Lists every member of a Spark archive with its sha256. For an uncompressed .tar the data
+    # offset of each file is recorded too, so single members can be fetched with a Range
+    # request. The manifest is written next to the archive as <archive>.manifest.json.
+    import json
+    import tarfile
+    import hashlib
+    try:
+        tf, seekable = tarfile.open(archive_path, "r:"), True
+    except tarfile.ReadError:
+        tf, seekable = tarfile.open(archive_path, "r|*"), False
+    members = []
+    with tf:
+        for member in tf:
+            if not (member.isfile() or member.isdir() or member.issym() or member.islnk()):
+                continue
+            sha256 = None
+            if member.isfile():
+                digest = hashlib.sha256()
+                data = tf.extractfile(member)
+                for block in iter(lambda: data.read(DOWNLOAD_BLOCK_SIZE), b""):
+                    digest.update(block)
+                sha256 = digest.hexdigest()
+            members.append(_manifest_entry(member, member.offset_data if seekable else None, sha256))
+    manifest = {"archive": os.path.basename(archive_path), "size": os.path.getsize(archive_path), "members": members}
+    if write:
+        _write_atomic(archive_path + ".manifest.json", json.dumps(manifest, indent=1).encode("utf-8"))
+    return manifest
+
+
+def spark_files_manifest(spark_version_dir):
+    # Path, size, mode and sha256 of every regular file of an installed version. Hashes are kept
+    # in <install_dir>/.manifests and only recomputed for files whose size or mtime changed.
+    import json
+    import stat
+    cache_file = os.path.join(spark_install_dir(), ".manifests", os.path.basename(spark_version_dir) + ".json")
+    previous = {}
+    try:
+        with open(cache_file) as f:
+            previous = dict((e["name"], e) for e in json.load(f)["members"])
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    members = []
+    for root, dirs, files in os.walk(spark_version_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            st = os.lstat(path)
+            if not stat.S_ISREG(st.st_mode):
                 continue
-            k, v = lines[i].split("=")
-            lines[i] = "=".join((k, properties.get(k, v)))
-            if k in properties:
-                del properties[k]
-
-    with open(log4jproperties_file, "w") as outfile:
-        outfile.writelines([line + NL for line in lines])
-        #Now write out values in Properties that didn't have base values in the template
-        for key, value in properties.items():
-            newline = "=".join((key, value))
-            outfile.writelines([newline + NL])
-
-
-def spark_hive_file_set_value(hive_path, properties):
-    with open(hive_path, "w") as hive_file:
-        hive_file.write("<configuration>" + NL)
-        for k, v in properties.items():
-            hive_file.write(NL.join(["  <property>",
-                                     "    <name>" + k + "</name>",
-                                     "    <value>" + str(v) + "</value>",
-                                     "  </property>" + NL]))
-        hive_file.write("</configuration>" + NL)
+            relative = os.path.relpath(path, spark_version_dir).replace(os.sep, "/")
+            entry = {"name": relative, "size": st.st_size, "mtime": st.st_mtime, "mode": stat.S_IMODE(st.st_mode)}
+            known = previous.get(relative)
+            if known and known["size"] == st.st_size and known["mtime"] == st.st_mtime:
+                entry["sha256"] = known["sha256"]
+            else:
+                entry["sha256"] = _file_digest(path)
+            members.append(entry)
 
+    if not os.path.isdir(os.path.dirname(cache_file)):
+        os.makedirs(os.path.dirname(cache_file))
+    _write_atomic(cache_file, json.dumps({"members": members}).encode("utf-8"))
+    return {"members": members}
 
-def spark_conf_file_set_value(install_info, properties, reset):
-    spark_conf_file = os.path.join(install_info["spark_conf_dir"], "spark-defaults.conf")
-    if not os.path.isfile(spark_conf_file) or reset:
-        template = os.path.join(install_info["spark_conf_dir"], "spark-defaults.conf.template")
-        shutil.copyfile(template, spark_conf_file)
 
-    max_key_len = 35
-    with open(spark_conf_file, "r") as infile:
-        lines = infile.readlines()
-        for i in range(len(lines)):
-            if lines[i].startswith("#") or " " not in lines[i]: continue
-            k, v = lines[i].split()
-            lines[i] = ' '.join((k.lpad(max_key_len), properties.get(k, v)))
+def _extract_manifest(manifest, spark_dir, write_files, reuse=None, member_filter=None, merge=False, cancel=None):
+    # Builds the members listed in an archive manifest in a staging directory. Files matching
+    # reuse are linked and write_files(staging, entries) provides the content of the others.
+    staging, staging_lock = _extract_staging(spark_dir)
+    files, dirs, links, pending = [], [], [], []
+    reused = set()
+    try:
+        for entry in manifest["members"]:
+            _check_cancel(cancel)
+            member = _manifest_tarinfo(entry)
+            if member_filter and not member_filter(member):
+                continue
+            target = _extract_target(staging, spark_dir, entry["name"])
+            if member.isdir():
+                if not os.path.isdir(target):
+                    os.makedirs(target)
+                dirs.append((target, member))
+                continue
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            if member.issym() or member.islnk():
+                links.append((target, member))
+                continue
+            files.append((target, member))
+            existing = reuse.get((entry["sha256"], entry["mode"])) if reuse else None
+            if existing:
+                _link_file(existing, target)
+                reused.add(target)
+            elif entry["size"]:
+                pending.append(entry)
+            else:
+                open(target, "wb").close()
+
+        written = write_files(staging, pending)
+        _extract_finish(staging, spark_dir, files, dirs, links, reused=reused, merge=merge)
+    finally:
+        _extract_release(staging, staging_lock)
+    return {"files": len(files), "reused": len(reused), "fetched_bytes": written}
+
+
+def _extract_indexed(tar_path, manifest, spark_dir, threads=None, member_filter=None, merge=False, cancel=None):
+    # An uncompressed tar with a manifest needs no sequential decompression: each worker seeks
+    # straight to the members of its share of the archive
+    from multiprocessing.pool import ThreadPool
+
+    def copy(staging, entries):
+        def copy_batch(batch):
+            with open(tar_path, "rb") as src:
+                for entry in batch:
+                    _check_cancel(cancel)
+                    src.seek(entry["offset"])
+                    with open(_extract_target(staging, spark_dir, entry["name"]), "wb") as dst:
+                        remaining = entry["size"]
+                        while remaining > 0:
+                            block = src.read(min(remaining, DOWNLOAD_BLOCK_SIZE))
+                            if not block:
+                                raise IOError("%s is truncated at %s" % (tar_path, entry["name"]))
+                            dst.write(block)
+                            remaining -= len(block)
+
+        count = threads or EXTRACT_THREADS
+        per_batch = max(1, (len(entries) + count - 1) // count)
+        pool = ThreadPool(count)
+        try:
+            pool.map(copy_batch, [entries[i:i + per_batch] for i in range(0, len(entries), per_batch)], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return sum(e["size"] for e in entries)
+
+    return _extract_manifest(manifest, spark_dir, copy, member_filter=member_filter, merge=merge, cancel=cancel)
+
+
+def _repacked_path(info):
+    return os.path.join(info["spark_dir"], os.path.basename(info["spark_version_dir"]) + ".tar")
+
+
+def spark_archive_repack(archive_path, digests=None):
+    # Rewrites a compressed Spark archive as an uncompressed .tar with a member manifest so that
+    # reinstalls can extract it in parallel. The manifest records the digests of the original
+    # archive, which is removed, so a changed digest in versions.json still invalidates it.
+    import json
+    import tarfile
+    tar_path = os.path.splitext(archive_path)[0] + ".tar"
+    digests = digests or _digest_recorded(archive_path) or {"sha256": _file_digest(archive_path)}
+    if tar_path != archive_path:
+        temp = "%s.%d.tmp" % (tar_path, os.getpid())
+        try:
+            with tarfile.open(archive_path, "r|*") as src:
+                with tarfile.open(temp, "w", format=tarfile.PAX_FORMAT) as dst:
+                    for member in src:
+                        dst.addfile(member, src.extractfile(member) if member.isfile() else None)
+            _replace_file(temp, tar_path)
+        except:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+    manifest = spark_archive_manifest(tar_path, write=False)
+    manifest.update(mtime=os.path.getmtime(tar_path), source={"name": os.path.basename(archive_path), "digests": digests})
+    _write_atomic(tar_path + ".manifest.json", json.dumps(manifest, indent=1).encode("utf-8"))
+    if tar_path != archive_path:
+        for path in (archive_path, archive_path + ".digest"):
+            if os.path.exists(path):
+                os.remove(path)
+    logging.info("Repacked %s into %s" % (archive_path, tar_path))
+    return tar_path
+
+
+def _spark_install_repacked(info):
+    # The manifest of a repacked archive, if there is one that still matches the archive and its digest
+    import json
+    tar_path = _repacked_path(info)
+    try:
+        with open(tar_path + ".manifest.json") as f:
+            manifest = json.load(f)
+        stat = os.stat(tar_path)
+    except (IOError, OSError, ValueError):
+        return None
+    if "source" not in manifest or manifest.get("size") != stat.st_size or manifest.get("mtime") != stat.st_mtime:
+        return None
+    if info["digest"]:
+        algorithm, value = _digest_split(info["digest"])
+        if manifest["source"]["digests"].get(algorithm) != value:
+            return None
+    return manifest
+
+
+def _conf_read(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read().decode("utf-8")
+    except (IOError, OSError):
+        return None
+
+
+def _conf_mode(path):
+    # Config files may hold credentials: an existing file keeps its mode and a new one gets 0666
+    # masked by the umask, as writing it in place would
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except OSError:
+        umask = os.umask(0o022)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+def _conf_write(path, content):
+    # Leaves the file (and anything watching it) alone unless the content really changes
+    if _conf_read(path) == content:
+        return False
+    _write_atomic(path, content.encode("utf-8"), _conf_mode(path))
+    return True
+
+
+def _conf_key(line, fmt):
+    stripped = line.strip()
+    if not stripped or stripped.startswith("#") or stripped.startswith("!"):
+        return None
+    if fmt == "properties":
+        return stripped.split("=", 1)[0].strip() if "=" in stripped else None
+    return stripped.split(None, 1)[0]
+
+
+def _conf_render(key, value, fmt):
+    if fmt == "properties":
+        return "%s=%s" % (key, value)
+    return "%-35s %s" % (key, value)
+
+
+def _conf_update(text, properties, fmt):
+    lines = text.splitlines()
+    seen = set()
+    for i, line in enumerate(lines):
+        key = _conf_key(line, fmt)
+        if key in properties:
+            lines[i] = _conf_render(key, properties[key], fmt)
+            seen.add(key)
+    lines.extend(_conf_render(k, v, fmt) for k, v in properties.items() if k not in seen)
+    return "\n".join(lines) + "\n"
+
 
-    with open(spark_conf_file, "w") as outfile:
-        outfile.writelines([line + NL for line in lines])
+def _conf_set_value(conf_file, properties, reset, fmt):
+    base = None if reset else _conf_read(conf_file)
+    if base is None:
+        base = _conf_read(conf_file + ".template") or ""
+    return _conf_write(conf_file, _conf_update(base, properties, fmt))
+
+
+def _hive_parse(text):
+    from collections import OrderedDict
+    import xml.etree.ElementTree as ET
+    properties = OrderedDict()
+    try:
+        for prop in ET.fromstring(text).findall("property"):
+            properties[prop.findtext("name")] = prop.findtext("value") or ""
+    except ET.ParseError:
+        logging.warning("Ignoring unreadable hive-site.xml content")
+    return properties
+
+
+def _hive_render(properties):
+    from xml.sax.saxutils import escape
+    lines = ["<configuration>"]
+    for k, v in properties.items():
+        lines.extend(["  <property>",
+                      "    <name>" + escape(k) + "</name>",
+                      "    <value>" + escape(str(v)) + "</value>",
+                      "  </property>"])
+    lines.append("</configuration>")
+    return "\n".join(lines) + "\n"
+
+
+def spark_conf_log4j_set_value(install_info, properties, reset):
+    log4jproperties_file = os.path.join(install_info["spark_conf_dir"], "log4j.properties")
+    return _conf_set_value(log4jproperties_file, properties, reset, "properties")
 
 
-def spark_set_env_vars(spark_version_dir):
+def spark_hive_file_set_value(hive_path, properties, reset=True):
+    merged = _hive_parse("<configuration/>" if reset else _conf_read(hive_path) or "<configuration/>")
+    merged.update(properties)
+    return _conf_write(hive_path, _hive_render(merged))
+
+
+def spark_conf_file_set_value(install_info, properties, reset):
+    spark_conf_file = os.path.join(install_info["spark_conf_dir"], "spark-defaults.conf")
+    return _conf_set_value(spark_conf_file, properties, reset, "conf")
+
+
+def spark_config_set(versions=None, log4j=None, defaults=None, hive=None, reset=False):
+    # Applies the same property changes to every installed version (or the given version pairs)
+    # in one pass and returns the files that actually changed
+    targets = spark_installed_versions()
+    if versions is not None:
+        pairs = set(_parse_version_pairs(versions))
+        targets = [v for v in targets if (v["spark"], v["hadoop"]) in pairs]
+
+    changed = []
+    for version in targets:
+        info = {"spark_version_dir": version["dir"], "spark_conf_dir": os.path.join(version["dir"], "conf")}
+        if log4j and spark_conf_log4j_set_value(info, log4j, reset):
+            changed.append(os.path.join(info["spark_conf_dir"], "log4j.properties"))
+        if defaults and spark_conf_file_set_value(info, defaults, reset):
+            changed.append(os.path.join(info["spark_conf_dir"], "spark-defaults.conf"))
+        if hive and spark_hive_file_set_value(os.path.join(info["spark_conf_dir"], "hive-site.xml"), hive, reset):
+            changed.append(os.path.join(info["spark_conf_dir"], "hive-site.xml"))
+    return changed
+
+
+def spark_set_env_vars(spark_version_dir, zipfiles=None, persist=True):
     import glob
-    zipfiles = glob.glob(os.path.join(spark_version_dir, "python", "lib", "*.zip"))
+    if zipfiles is None:
+        zipfiles = glob.glob(os.path.join(spark_version_dir, "python", "lib", "*.zip"))
     path_values = []
     if zipfiles != [] and zipfiles[0] not in sys.path:
         position = [index for (index, path) in enumerate(sys.path) if
@@ -238,7 +1756,8 @@ def spark_set_env_vars(spark_version_dir):
     persistent_vars = {}
 
     path_delim = ";" if sys.platform == "win32" else ":"
-    path_values = os.environ.get("PYTHONPATH", "").split(path_delim)
+    # An unset PYTHONPATH would otherwise leave an empty entry, which means the current directory
+    path_values = [path for path in os.environ.get("PYTHONPATH", "").split(path_delim) if path]
     if zipfiles != [] and zipfiles[0] not in path_values:
         position = [index for (index, path) in enumerate(path_values) if
                     re.match(SPARK_VERSIONS_FILE_PATTERN, path)] or len(path_values)
@@ -250,7 +1769,7 @@ def spark_set_env_vars(spark_version_dir):
         os.environ["SPARK_HOME"] = spark_version_dir
         persistent_vars["SPARK_HOME"] = spark_version_dir
 
-    if persistent_vars == {}:
+    if persistent_vars == {} or not persist:
         return
 
     if sys.platform == "win32":
@@ -274,6 +1793,55 @@ def spark_set_env_vars(spark_version_dir):
         for k, v in persistent_vars.items():
             logging.info("export %s = %s" % (k, v))
 
+def _activation_stamp(base_dir, spark_home):
+    try:
+        return [os.stat(base_dir).st_mtime, os.stat(os.path.join(spark_home, "python", "lib")).st_mtime]
+    except OSError:
+        return None
+
+
+def spark_activate(spark_version=None, hadoop_version=None):
+    # Points this process at an installed Spark using only the directory layout, without loading
+    # versions.json. Resolved paths are remembered in .activation/index.json until the install
+    # directory or the version's python/lib changes.
+    import glob
+    import json
+    base_dir = spark_install_dir()
+    index_file = os.path.join(base_dir, ".activation", "index.json")
+    try:
+        with open(index_file) as f:
+            index = json.load(f)
+    except (IOError, OSError, ValueError):
+        index = {}
+
+    key = _combine_versions(spark_version or "", hadoop_version or "")
+    entry = index.get(key)
+    if not entry or entry["stamp"] != _activation_stamp(base_dir, entry["spark_home"]):
+        versions = [v for v in _spark_installed_scan(base_dir) if
+                    (not spark_version or v["spark"] == spark_version) and
+                    (not hadoop_version or v["hadoop"] == hadoop_version)]
+        if versions == []:
+            raise RuntimeError("No installed Spark found for Spark version %s and Hadoop version %s" % (spark_version, hadoop_version))
+        spark_home = max(versions, key=lambda rec: _combine_versions(rec["spark"], rec["hadoop"]))["dir"]
+        if not os.path.isdir(os.path.dirname(index_file)):
+            os.makedirs(os.path.dirname(index_file))
+        entry = {"spark_home": spark_home,
+                 "zipfiles": sorted(glob.glob(os.path.join(spark_home, "python", "lib", "*.zip"))),
+                 "stamp": _activation_stamp(base_dir, spark_home)}
+        index[key] = entry
+        _write_atomic(index_file, json.dumps(index, indent=2).encode("utf-8"))
+
+    spark_home = entry["spark_home"]
+    if not os.path.isfile(os.path.join(spark_home, "conf", "log4j.properties")):
+        _spark_install_configure({"spark_version_dir": spark_home, "spark_conf_dir": os.path.join(spark_home, "conf")}, reset=False)
+
+    for zipfile in reversed(entry["zipfiles"]):
+        if zipfile not in sys.path:
+            sys.path.insert(0, zipfile)
+    spark_set_env_vars(spark_home, entry["zipfiles"], persist=False)
+    return {"spark_home": spark_home, "zipfiles": entry["zipfiles"]}
+
+
 def spark_remove_env_vars():
     # Remove env variables since there's no other spark installed.
     os.environ.pop("SPARK_HOME")
@@ -281,15 +1849,111 @@ def spark_remove_env_vars():
     os.unsetenv("SPARK_HOME")
     os.unsetenv("PYTHONPATH")
 
-def spark_install_winutils(spark_dir, hadoop_version):
+class _RangeReader(object):
+    # Read-only, seekable view of a remote file that fetches only the byte ranges being read
+    def __init__(self, url, size):
+        self.url = url
+        self.size = size
+        self.pos = 0
+        self.buffer_start = 0
+        self.buffer = b""
+        self.bytes = 0
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        self.pos = offset
+        return self.pos
+
+    def fetch(self, start, end):
+        response = _urlopen(self.url, {"Range": "bytes=%d-%d" % (start, end - 1)})
+        try:
+            if response.getcode() != 206:
+                raise IOError("Server ignored range request for %s" % self.url)
+            self.buffer = response.read()
+        finally:
+            response.close()
+        self.buffer_start = start
+        self.bytes += len(self.buffer)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.pos
+        size = min(size, self.size - self.pos)
+        if size <= 0:
+            return b""
+        if not (self.buffer_start <= self.pos and self.pos + size <= self.buffer_start + len(self.buffer)):
+            self.fetch(self.pos, min(self.size, self.pos + max(size, DOWNLOAD_BLOCK_SIZE)))
+        offset = self.pos - self.buffer_start
+        data = self.buffer[offset:offset + size]
+        self.pos += len(data)
+        return data
+
+
+def _winutils_extract(source, spark_dir, hadoop_version):
+    # Extracts only winutils-master/hadoop-<version>*/ into spark_dir through a staging directory
+    from zipfile import ZipFile
+    prefix = "hadoop-" + hadoop_version
+    with ZipFile(source) as zf:
+        members = [m for m in zf.infolist() if len(m.filename.split("/")) > 2 and m.filename.split("/")[1].startswith(prefix)]
+        if not members:
+            return
+        if isinstance(source, _RangeReader):
+            # Members of one Hadoop version sit next to each other, fetch them with a single request
+            offsets = sorted(set([m.header_offset for m in zf.infolist()] + [zf.start_dir]))
+            last = max(m.header_offset for m in members)
+            source.fetch(min(m.header_offset for m in members), offsets[offsets.index(last) + 1])
+        staging, staging_lock = _extract_staging(spark_dir)
+        try:
+            for member in members:
+                zf.extract(member, staging)
+            top = members[0].filename.split("/")[0]
+            if not os.path.isdir(os.path.join(spark_dir, top)):
+                os.makedirs(os.path.join(spark_dir, top))
+            for entry in os.listdir(os.path.join(staging, top)):
+                if not os.path.exists(os.path.join(spark_dir, top, entry)):
+                    os.rename(os.path.join(staging, top, entry), os.path.join(spark_dir, top, entry))
+        finally:
+            _extract_release(staging, staging_lock)
+
+
+def spark_install_winutils(spark_dir, hadoop_version, cache_dir=None):
+    # Only the binaries of the requested Hadoop version are extracted. When the server supports
+    # ranges they are read straight out of the remote zip; otherwise the whole zip is downloaded
+    # once and kept, in the shared archive cache when one is configured. WINUTILS_URL is a
+    # snapshot of a moving branch, so there is no digest to check it against.
     import glob
-    if not os.path.isdir(os.path.join(spark_dir, "winutils-master")):
-        _download_file(WINUTILS_URL, os.path.join(spark_dir, "winutils-master.zip"))
-        from zipfile import ZipFile
-        with ZipFile(os.path.join(spark_dir, "winutils-master.zip")) as zf:
-            zf.extractall(spark_dir)
+    pattern = os.path.join(spark_dir, "winutils-master", "hadoop-" + hadoop_version + "*")
+    if not glob.glob(pattern):
+        local_zip = os.path.join(spark_dir, "winutils-master.zip")
+        cache_dir = cache_dir or spark_cache_dir()
+        if not os.path.isfile(local_zip) and cache_dir:
+            spark_cache_get("winutils-master.zip", local_zip, cache_dir)
+        if os.path.isfile(local_zip):
+            _winutils_extract(local_zip, spark_dir, hadoop_version)
+        else:
+            size, response = _download_probe(WINUTILS_URL)
+            if response is not None:
+                response.close()
+            if response is None and size:
+                reader = _RangeReader(WINUTILS_URL, size)
+                _winutils_extract(reader, spark_dir, hadoop_version)
+                logging.debug("Fetched %d of %d bytes from %s" % (reader.bytes, size, WINUTILS_URL))
+            else:
+                _download_file(WINUTILS_URL, local_zip)
+                if cache_dir:
+                    spark_cache_put("winutils-master.zip", local_zip, cache_dir)
+                _winutils_extract(local_zip, spark_dir, hadoop_version)
 
-    candidates = glob.glob(os.path.join(spark_dir, "winutils-master", "hadoop-" + hadoop_version + "*"))
+    candidates = sorted(glob.glob(pattern))
 
     if candidates == []:
         logging.info("No compatible WinUtils found for Hadoop version %s." % hadoop_version)
@@ -298,27 +1962,196 @@ def spark_install_winutils(spark_dir, hadoop_version):
     os.environ["HADOOP_HOME"] = candidates[-1]
 
 
-def spark_install(spark_version=None, hadoop_version=None, reset=True, loglevel="INFO"):
+_metrics_callbacks = []
 
-    info = spark_install_find(spark_version, hadoop_version, installed_only=False)
 
-    spark_can_install()
+def spark_metrics_add(callback):
+    _metrics_callbacks.append(callback)
 
-    logging.info("Installing and configuring Spark version: %s, Hadoop version: %s" % (info["spark"], info["hadoop"]))
 
-    if not os.path.isdir(info["spark_version_dir"]):
-        if not os.path.isfile(info["package_local_path"]):
-            import urllib
-            logging.info("Downloading %s into %s" % (info["package_remote_path"], info["package_local_path"]))
-            _download_file(info["package_remote_path"], info["package_local_path"])
+def spark_metrics_remove(callback):
+    if callback in _metrics_callbacks:
+        _metrics_callbacks.remove(callback)
+
+
+def _metrics_emit(event, metrics=None):
+    # Goes to every registered callback and to the metrics callback of the install it belongs to
+    for callback in list(_metrics_callbacks) + ([metrics] if metrics else []):
+        try:
+            callback(event)
+        except Exception as e:
+            logging.debug("Metrics callback %r failed: %s" % (callback, e))
+
+
+@contextmanager
+def spark_metrics_phase(phase, metrics=None, **fields):
+    # Emits a start and an end event around a block. The block may add fields such as "bytes"
+    # to the yielded record, which the end event reports along with the throughput. Besides the
+    # registered callbacks, the events go to metrics when it is given.
+    import time
+    record = dict(fields, phase=phase)
+    _metrics_emit(dict(record, event="start", time=time.time()), metrics)
+    started = time.time()
+    ok = False
+    try:
+        yield record
+        ok = True
+    finally:
+        record.update(event="end", ok=ok, time=time.time(), seconds=time.time() - started)
+        if record.get("bytes") and record["seconds"] > 0:
+            record["throughput"] = record["bytes"] / record["seconds"]
+        _metrics_emit(record, metrics)
+
+
+def spark_metrics_jsonl(path):
+    import json
+    lock = threading.Lock()
+
+    def write(event):
+        with lock:
+            with open(path, "a") as f:
+                f.write(json.dumps(event, sort_keys=True) + "\n")
+    return write
+
+
+def _metrics_progress(phase, metrics=None):
+    def progress(done, total):
+        phase["bytes"] = done
+        _metrics_emit(dict(phase, event="progress", total=total), metrics)
+    return progress
+
+
+def spark_install_profile(profile=None, include=None, exclude=None):
+    # Resolves a profile name, or custom include/exclude globs, to {"include": [...], "exclude": [...]}
+    if include or exclude:
+        return {"include": list(include or ["*"]), "exclude": list(exclude or [])}
+    if profile not in SPARK_INSTALL_PROFILES and profile is not None:
+        raise ValueError("Unknown install profile %s, expected one of %s" % (profile, ", ".join(sorted(SPARK_INSTALL_PROFILES))))
+    return SPARK_INSTALL_PROFILES[profile or "full"]
+
+
+def _profile_matches(profile, path, isdir=False):
+    from fnmatch import fnmatchcase
+    if isdir:
+        # A directory is kept when a pattern could match something beneath it
+        path += "/"
+        included = any(fnmatchcase(path, p) or p.startswith(path) for p in profile["include"])
+    else:
+        included = any(fnmatchcase(path, p) for p in profile["include"])
+    return included and not any(fnmatchcase(path, p) for p in profile["exclude"])
+
+
+def _spark_profiles_file(spark_version_dir):
+    return os.path.join(spark_version_dir, ".spark-install.json")
+
 
+def _spark_profiles_installed(spark_version_dir):
+    # Profiles extracted so far, or None when the whole distribution is there
+    import json
+    try:
+        with open(_spark_profiles_file(spark_version_dir)) as f:
+            return json.load(f)["profiles"]
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+
+def _spark_profiles_save(spark_version_dir, profiles):
+    import json
+    if SPARK_INSTALL_PROFILES["full"] in profiles:
+        if os.path.exists(_spark_profiles_file(spark_version_dir)):
+            os.remove(_spark_profiles_file(spark_version_dir))
+    else:
+        _write_atomic(_spark_profiles_file(spark_version_dir), json.dumps({"profiles": profiles}).encode("utf-8"))
+
+
+def _spark_profile_filter(profile, installed):
+    # Accepts members of profile that none of the installed profiles extracted already
+    def member_filter(member):
+        path = member.name.partition("/")[2].rstrip("/")
+        if not path:
+            return True
+        if member.isdir():
+            return _profile_matches(profile, path, True)
+        return _profile_matches(profile, path) and not any(_profile_matches(p, path) for p in installed)
+    return member_filter
+
+
+def _spark_install_cached(info, cache_dir=None):
+    # Looks for a verified archive at package_local_path, filling it from the shared cache first
+    if not os.path.isfile(info["package_local_path"]) and cache_dir:
+        cached = spark_cache_get(info["package_name"], info["package_local_path"], cache_dir)
+        if cached:
+            _digest_record(info["package_local_path"], {"sha256": cached})
+
+    if os.path.isfile(info["package_local_path"]) and not _archive_verified(info["package_local_path"], info["digest"]):
+        logging.warning("Discarding %s, its checksum does not match %s" % (info["package_local_path"], info["digest"]))
+        os.remove(info["package_local_path"])
+    return os.path.isfile(info["package_local_path"])
+
+
+def _spark_install_fetch(info, cache_dir=None, cancel=None, metrics=None):
+    with spark_metrics_phase("download", metrics, spark=info["spark"], hadoop=info["hadoop"], url=info["package_remote_path"]) as phase:
+        if _spark_install_repacked(info):
+            phase["source"] = "repacked"
+            return
+        if _spark_install_cached(info, cache_dir):
+            phase["source"] = "cache"
+            return
+        logging.info("Downloading %s into %s" % (info["package_remote_path"], info["package_local_path"]))
+        digests = _download_file(info["package_remote_path"], info["package_local_path"], digest=info["digest"],
+                                 progress=_metrics_progress(phase, metrics), mirrors=info["package_mirrors"], cancel=cancel)
+        phase["source"] = "network"
+        _digest_record(info["package_local_path"], digests)
+        if cache_dir:
+            spark_cache_put(info["package_name"], info["package_local_path"], cache_dir, digest=digests["sha256"])
+
+
+def _spark_install_stream(info, keep_archive=False, cache_dir=None, cancel=None, member_filter=None, metrics=None):
+    with spark_metrics_phase("stream", metrics, spark=info["spark"], hadoop=info["hadoop"], url=info["package_remote_path"]) as phase:
+        url = spark_mirrors_rank([info["package_remote_path"]] + info["package_mirrors"])[0]
+        logging.info("Streaming %s into %s" % (url, info["spark_dir"]))
+        digests = _download_extract(url, info["spark_dir"],
+                                    info["package_local_path"] if keep_archive or cache_dir else None,
+                                    info["digest"], _metrics_progress(phase, metrics), cancel=cancel,
+                                    member_filter=member_filter, merge=member_filter is not None)
+        phase["source"] = "network"
+        if cache_dir:
+            spark_cache_put(info["package_name"], info["package_local_path"], cache_dir, digest=digests["sha256"])
+        if keep_archive:
+            _digest_record(info["package_local_path"], digests)
+        elif cache_dir:
+            os.remove(info["package_local_path"])
+
+
+def _spark_install_extract(info, cancel=None, member_filter=None, metrics=None):
+    with spark_metrics_phase("extract", metrics, spark=info["spark"], hadoop=info["hadoop"]) as phase:
+        manifest = _spark_install_repacked(info)
+        if manifest:
+            logging.info("Extracting %s into %s" % (_repacked_path(info), info["spark_dir"]))
+            phase.update(bytes=manifest["size"], source="repacked")
+            _extract_indexed(_repacked_path(info), manifest, info["spark_dir"], cancel=cancel,
+                             member_filter=member_filter, merge=member_filter is not None)
+            return
         logging.info("Extracting %s into %s" % (info["package_local_path"], info["spark_dir"]))
-        import tarfile
-        with tarfile.open(info["package_local_path"]) as tf:
-            tf.extractall(info["spark_dir"])
+        phase["bytes"] = os.path.getsize(info["package_local_path"])
+        _extract_archive(info["package_local_path"], info["spark_dir"], cancel=cancel,
+                         member_filter=member_filter, merge=member_filter is not None)
+
+
+def _spark_install_repack(info, metrics=None):
+    if os.path.isfile(info["package_local_path"]) and not _spark_install_repacked(info):
+        with spark_metrics_phase("repack", metrics, spark=info["spark"], hadoop=info["hadoop"]) as phase:
+            phase["bytes"] = os.path.getsize(spark_archive_repack(info["package_local_path"]))
+
 
+def _spark_install_configure(info, reset=True, loglevel="INFO", metrics=None):
+    with spark_metrics_phase("configure", metrics, spark=info.get("spark"), hadoop=info.get("hadoop")):
+        _spark_install_configure_files(info, reset, loglevel)
+
+
+def _spark_install_configure_files(info, reset=True, loglevel="INFO"):
+    from collections import OrderedDict
     if loglevel:
-        from collections import OrderedDict
         configs = OrderedDict()
         configs["log4j.rootCategory"] = ",".join((loglevel, "console", "localfile"))
         configs["log4j.appender.localfile"] = "org.apache.log4j.DailyRollingFileAppender"
@@ -348,10 +2181,328 @@ def spark_install(spark_version=None, hadoop_version=None, reset=True, loglevel=
             spark_properties["spark.sql.warehouse.dir"] = hive_path
             spark_conf_file_set_value(info, spark_properties, reset)
 
-    spark_set_env_vars(info["spark_version_dir"])
+
+def spark_install(spark_version=None, hadoop_version=None, reset=True, loglevel="INFO", stream=False, keep_archive=False, cache_dir=None, dedup=False, metrics=None, cancel=None, profile=None, repack=False):
+
+    with spark_metrics_phase("resolve", metrics, spark=spark_version, hadoop=hadoop_version) as phase:
+        info = spark_install_find(spark_version, hadoop_version, installed_only=False)
+        phase.update(spark=info["spark"], hadoop=info["hadoop"])
+
+    spark_can_install()
+
+    logging.info("Installing and configuring Spark version: %s, Hadoop version: %s" % (info["spark"], info["hadoop"]))
+
+    if not isinstance(profile, dict):
+        profile = spark_install_profile(profile)
+
+    def missing():
+        if not os.path.isdir(info["spark_version_dir"]):
+            return True
+        installed = _spark_profiles_installed(info["spark_version_dir"])
+        return installed is not None and profile not in installed and SPARK_INSTALL_PROFILES["full"] not in installed
+
+    if not missing():
+        _spark_install_configure(info, reset, loglevel, metrics)
+    else:
+        # One process downloads and extracts while the others wait on the lock and reuse its
+        # result. The lock is held through configuration so that spark_installed_versions()
+        # only lists completed installs.
+        with _spark_install_lock(info["spark_version_dir"]):
+            if not missing():
+                logging.info("Reusing %s installed by another process" % info["spark_version_dir"])
+            else:
+                # A version installed with a smaller profile only gets the members it lacks
+                installed = _spark_profiles_installed(info["spark_version_dir"]) if os.path.isdir(info["spark_version_dir"]) else []
+                member_filter = None
+                if installed or profile != SPARK_INSTALL_PROFILES["full"]:
+                    member_filter = _spark_profile_filter(profile, installed)
+                cache_dir = cache_dir or spark_cache_dir()
+                _extract_cleanup(info["spark_dir"])
+                if stream and not _spark_install_repacked(info) and not _spark_install_cached(info, cache_dir):
+                    _spark_install_stream(info, keep_archive, cache_dir, cancel, member_filter, metrics)
+                else:
+                    _spark_install_fetch(info, cache_dir, cancel, metrics)
+                    _spark_install_extract(info, cancel, member_filter, metrics)
+                if repack:
+                    _spark_install_repack(info, metrics)
+                if installed or profile != SPARK_INSTALL_PROFILES["full"]:
+                    _spark_profiles_save(info["spark_version_dir"], installed + [profile])
+                if dedup:
+                    with spark_metrics_phase("dedup", metrics, spark=info["spark"], hadoop=info["hadoop"]) as phase:
+                        # This version is hidden from spark_installed_versions() until the lock is released
+                        version_dirs = [v["dir"] for v in spark_installed_versions()] + [info["spark_version_dir"]]
+                        phase["saved_bytes"] = spark_dedup(version_dirs)["saved_bytes"]
+            _spark_install_configure(info, reset, loglevel, metrics)
+
+    with spark_metrics_phase("env", metrics, spark=info["spark"], hadoop=info["hadoop"]):
+        spark_set_env_vars(info["spark_version_dir"])
 
     if sys.platform == "win32":
-        spark_install_winutils(info["spark_dir"], info["hadoop"])
+        with spark_metrics_phase("winutils", metrics, spark=info["spark"], hadoop=info["hadoop"]):
+            spark_install_winutils(info["spark_dir"], info["hadoop"], cache_dir=cache_dir)
+
+
+def _upgrade_remote_manifest(url):
+    import json
+    try:
+        response = _urlopen(url + ".manifest.json")
+        try:
+            return json.loads(response.read().decode("utf-8"))
+        finally:
+            response.close()
+    except Exception as e:
+        logging.debug("No manifest for %s: %s" % (url, e))
+        return None
+
+
+def _upgrade_groups(members):
+    # Coalesces members that sit close together in the archive into a single Range request
+    groups = []
+    for entry in sorted(members, key=lambda e: e["offset"]):
+        if groups and entry["offset"] - groups[-1]["end"] <= UPGRADE_RANGE_GAP and \
+                groups[-1]["end"] - groups[-1]["start"] + entry["size"] <= DOWNLOAD_CHUNK_SIZE:
+            groups[-1]["members"].append(entry)
+            groups[-1]["end"] = entry["offset"] + entry["size"]
+        else:
+            groups.append({"start": entry["offset"], "end": entry["offset"] + entry["size"], "members": [entry]})
+    return groups
+
+
+def _upgrade_fetch_group(url, staging, spark_dir, group):
+    import hashlib
+    response = _urlopen(url, {"Range": "bytes=%d-%d" % (group["start"], group["end"] - 1)})
+    try:
+        if response.getcode() != 206:
+            raise IOError("%s does not support range requests" % url)
+        position = group["start"]
+        for entry in group["members"]:
+            skip = entry["offset"] - position
+            while skip > 0:
+                skipped = len(response.read(min(skip, DOWNLOAD_BLOCK_SIZE)))
+                if not skipped:
+                    raise IOError("Incomplete range response from %s" % url)
+                skip -= skipped
+            digest = hashlib.sha256()
+            target = _extract_target(staging, spark_dir, entry["name"])
+            with open(target, "wb") as f:
+                remaining = entry["size"]
+                while remaining > 0:
+                    block = response.read(min(remaining, DOWNLOAD_BLOCK_SIZE))
+                    if not block:
+                        raise IOError("Incomplete range response from %s" % url)
+                    digest.update(block)
+                    f.write(block)
+                    remaining -= len(block)
+            if digest.hexdigest() != entry["sha256"]:
+                raise IOError("Checksum mismatch for %s in %s" % (entry["name"], url))
+            position = entry["offset"] + entry["size"]
+    finally:
+        response.close()
+    return group["end"] - group["start"]
+
+
+def _upgrade_ranged(url, manifest, spark_dir, reuse, threads=None):
+    # Builds the target version from its manifest: members matching an installed file are
+    # linked, the rest are fetched from the archive with Range requests
+    from multiprocessing.pool import ThreadPool
+
+    def fetch(staging, entries):
+        pool = ThreadPool(threads or DOWNLOAD_THREADS)
+        try:
+            return sum(pool.map(lambda group: _upgrade_fetch_group(url, staging, spark_dir, group), _upgrade_groups(entries), chunksize=1))
+        finally:
+            pool.close()
+            pool.join()
+
+    return _extract_manifest(manifest, spark_dir, fetch, reuse)
+
+
+def spark_upgrade(from_spark, from_hadoop, to_spark=None, to_hadoop=None, reset=True, loglevel="INFO", cache_dir=None):
+    # Installs a new version next to an installed one, linking the files both have in common
+    # instead of fetching them again. When the mirror serves <archive>.manifest.json for an
+    # uncompressed archive only the changed members are downloaded; otherwise the archive is
+    # streamed and matching members are linked rather than written.
+    source = spark_install_info(from_spark, from_hadoop)
+    if not source["installed"]:
+        raise RuntimeError("Spark %s for Hadoop %s is not installed" % (from_spark, from_hadoop))
+    target = spark_install_find(to_spark, to_hadoop or from_hadoop, installed_only=False)
+    stats = {"mode": "installed", "files": 0, "reused": 0, "fetched_bytes": 0}
+
+    with _spark_install_lock(target["spark_version_dir"]):
+        if not os.path.isdir(target["spark_version_dir"]):
+            reuse = {}
+            for entry in spark_files_manifest(source["spark_version_dir"])["members"]:
+                reuse.setdefault((entry["sha256"], entry["mode"]), os.path.join(source["spark_version_dir"], entry["name"]))
+
+            with spark_metrics_phase("upgrade", spark=target["spark"], hadoop=target["hadoop"], url=target["package_remote_path"]) as phase:
+                cache_dir = cache_dir or spark_cache_dir()
+                if _spark_install_cached(target, cache_dir):
+                    stats.update(_extract_archive(target["package_local_path"], target["spark_dir"], reuse=reuse), mode="local")
+                else:
+                    url = spark_mirrors_rank([target["package_remote_path"]] + target["package_mirrors"])[0]
+                    manifest = _upgrade_remote_manifest(url)
+                    # The manifest itself is unsigned, so a pinned archive digest means the whole
+                    # archive is streamed and checked against it instead
+                    ranged = manifest and not target["digest"] and \
+                        all(e.get("offset") is not None for e in manifest["members"] if e["type"] == "file")
+                    if ranged:
+                        response = _download_probe(url)[1]
+                        if response is not None:
+                            response.close()
+                            ranged = False
+                    if ranged:
+                        # Each fetched member is checked against its sha256 in the manifest, as there
+                        # is no archive digest to check
+                        stats.update(_upgrade_ranged(url, manifest, target["spark_dir"], reuse), mode="ranged")
+                    else:
+                        stats["mode"] = "stream"
+                        _download_extract(url, target["spark_dir"], digest=target["digest"],
+                                          progress=_metrics_progress(phase), reuse=reuse, stats=stats)
+                phase.update(stats)
+            logging.info("Upgraded to %s reusing %d of %d files from %s, fetched %d bytes" %
+                         (target["spark_version_dir"], stats["reused"], stats["files"], source["spark_version_dir"], stats["fetched_bytes"]))
+
+    spark_install(target["spark"], target["hadoop"], reset, loglevel)
+    return stats
+
+
+def _parse_version_pairs(values):
+    # Accepts "spark:hadoop" strings, (spark, hadoop) pairs or {"spark": ..., "hadoop": ...} records
+    pairs = []
+    for value in values:
+        if isinstance(value, dict):
+            pairs.append((value["spark"], value["hadoop"]))
+        elif isinstance(value, (list, tuple)):
+            pairs.append((value[0], value[1]))
+        else:
+            spark_version, _, hadoop_version = value.strip().partition(":")
+            pairs.append((spark_version, hadoop_version or None))
+    return pairs
+
+
+def spark_versions_manifest(path):
+    import json
+    with open(path) as mf:
+        return _parse_version_pairs(json.load(mf))
+
+
+def spark_install_batch(versions, reset=True, loglevel="INFO", cache_dir=None, max_downloads=4, dedup=False, metrics=None, repack=False):
+    # Downloads run concurrently on a bounded pool while a single extraction worker (itself
+    # multi-threaded) unpacks each archive as soon as it arrives.
+    import time
+    from multiprocessing.pool import ThreadPool
+
+    spark_can_install()
+    cache_dir = cache_dir or spark_cache_dir()
+    _extract_cleanup(spark_install_dir())
+    jobs = []
+    seen = set()
+    for spark_version, hadoop_version in _parse_version_pairs(versions):
+        info = spark_install_find(spark_version, hadoop_version, installed_only=False)
+        if info["spark_version_dir"] in seen:
+            continue
+        seen.add(info["spark_version_dir"])
+        jobs.append({"info": info, "spark": info["spark"], "hadoop": info["hadoop"], "status": "pending"})
+
+    download_pool = ThreadPool(max(1, min(max_downloads, len(jobs))))
+    extract_pool = ThreadPool(1)
+    extractions = []
+
+    def extract(job):
+        try:
+            if job["status"] == "pending":
+                started = time.time()
+                _spark_install_extract(job["info"], metrics=metrics)
+                job["extract"] = time.time() - started
+                if repack:
+                    _spark_install_repack(job["info"], metrics)
+            started = time.time()
+            _spark_install_configure(job["info"], reset, loglevel, metrics)
+            job["configure"] = time.time() - started
+            if job["status"] == "pending":
+                job["status"] = "installed"
+        except Exception as e:
+            logging.critical("Failed to install Spark %s, Hadoop %s: %s" % (job["spark"], job["hadoop"], e))
+            job.update(status="failed", error=str(e))
+        finally:
+            if job.get("lock"):
+                job.pop("lock").__exit__(None, None, None)
+        job["total"] = time.time() - job["started"]
+
+    def download(job):
+        # The install lock taken here is released by extract() once the version is configured
+        job["started"] = time.time()
+        try:
+            if not os.path.isdir(job["info"]["spark_version_dir"]):
+                job["lock"] = _spark_install_lock(job["info"]["spark_version_dir"]).__enter__()
+            if os.path.isdir(job["info"]["spark_version_dir"]):
+                job["status"] = "configured"
+            else:
+                _spark_install_fetch(job["info"], cache_dir, metrics=metrics)
+                job["download"] = time.time() - job["started"]
+        except Exception as e:
+            logging.critical("Failed to download Spark %s, Hadoop %s: %s" % (job["spark"], job["hadoop"], e))
+            job.update(status="failed", error=str(e), total=time.time() - job["started"])
+            if job.get("lock"):
+                job.pop("lock").__exit__(None, None, None)
+            return
+        extractions.append(extract_pool.apply_async(extract, (job,)))
+
+    try:
+        download_pool.map(download, jobs, chunksize=1)
+        for extraction in list(extractions):
+            extraction.wait()
+    finally:
+        download_pool.close()
+        extract_pool.close()
+        download_pool.join()
+        extract_pool.join()
+
+    if dedup:
+        spark_dedup()
+
+    if sys.platform == "win32":
+        # The winutils archive is shared by every job, fetch it once per Hadoop version
+        for hadoop_version in sorted(set(job["hadoop"] for job in jobs if job["status"] != "failed")):
+            spark_install_winutils(spark_install_dir(), hadoop_version, cache_dir=cache_dir)
+
+    for job in jobs:
+        del job["info"]
+        job.pop("started", None)
+    return jobs
+
+
+def spark_uninstall_batch(versions, max_workers=4):
+    # A pair missing its Spark or Hadoop version removes the newest installed match. Failures are
+    # recorded per version, like spark_install_batch(), instead of aborting the other uninstalls.
+    from multiprocessing.pool import ThreadPool
+    jobs = []
+    for spark_version, hadoop_version in _parse_version_pairs(versions):
+        job = {"spark": spark_version, "hadoop": hadoop_version, "status": "pending"}
+        jobs.append(job)
+        if not (spark_version and hadoop_version):
+            try:
+                info = spark_install_find(spark_version or None, hadoop_version or None, installed_only=True)
+                job.update(spark=info["spark"], hadoop=info["hadoop"])
+            except Exception as e:
+                logging.critical("Failed to uninstall Spark %s, Hadoop %s: %s" % (spark_version, hadoop_version, e))
+                job.update(status="failed", error=str(e))
+
+    def uninstall(job):
+        try:
+            spark_uninstall(job["spark"], job["hadoop"])
+            job["status"] = "uninstalled"
+        except Exception as e:
+            logging.critical("Failed to uninstall Spark %s, Hadoop %s: %s" % (job["spark"], job["hadoop"], e))
+            job.update(status="failed", error=str(e))
+
+    pool = ThreadPool(max_workers)
+    try:
+        pool.map(uninstall, [job for job in jobs if job["status"] == "pending"], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return jobs
 
 
 def main():
@@ -361,6 +2512,20 @@ def main():
     parser.add_argument("-hv", "--hadoop-version", help="Hadoop Version to be used.", required=False, dest="hadoop_version")
     parser.add_argument("-u", "--uninstall", help="Uninstall Spark", action="store_true", default=False, required=False)
     parser.add_argument("-i", "--information", help="Show installed versions of Spark", action="store_true", default=False, required=False)
+    parser.add_argument("-s", "--stream", help="Extract while downloading instead of saving the archive first", action="store_true", default=False, required=False)
+    parser.add_argument("-k", "--keep-archive", help="Keep a copy of the archive when streaming", action="store_true", default=False, required=False, dest="keep_archive")
+    parser.add_argument("-c", "--cache-dir", help="Shared archive cache directory", required=False, dest="cache_dir")
+    parser.add_argument("-b", "--batch", help="Comma separated list of spark:hadoop version pairs to install or uninstall", required=False)
+    parser.add_argument("-m", "--manifest", help="JSON file listing the {\"spark\", \"hadoop\"} version pairs to install or uninstall", required=False)
+    parser.add_argument("-j", "--jobs", help="Number of concurrent downloads in batch mode", type=int, default=4, required=False)
+    parser.add_argument("-d", "--dedup", help="Hardlink identical files across installed versions", action="store_true", default=False, required=False)
+    parser.add_argument("-a", "--activate", help="Print the environment for an installed version without contacting the network", action="store_true", default=False, required=False)
+    parser.add_argument("-p", "--profile", help="Parts of the distribution to install", choices=sorted(SPARK_INSTALL_PROFILES), required=False)
+    parser.add_argument("--include", help="Comma separated globs of files to install, relative to the Spark directory", required=False)
+    parser.add_argument("--exclude", help="Comma separated globs of files to leave out", required=False)
+    parser.add_argument("-r", "--repack", help="Keep downloaded archives as uncompressed tars with an index for faster reinstalls", action="store_true", default=False, required=False)
+    parser.add_argument("--upgrade-from", help="Installed spark:hadoop version to reuse unchanged files from", required=False, dest="upgrade_from")
+    parser.add_argument("--metrics-file", help="Append JSON lines with per phase timings to this file", required=False, dest="metrics_file")
     parser.add_argument("-l", "--log-level", help="Set the log level", choices=["DEBUG", "INFO", "WARNING"], default="WARNING", required=False, dest="log_level")
 
     args = parser.parse_args()
@@ -376,12 +2541,35 @@ def main():
     logging.debug("Uninstall argument: %s" % args.uninstall)
     logging.debug("Information argument: %s" % args.information)
 
+    if args.metrics_file:
+        spark_metrics_add(spark_metrics_jsonl(args.metrics_file))
+
+    batch = None
+    if args.batch:
+        batch = _parse_version_pairs(args.batch.split(","))
+    elif args.manifest:
+        batch = spark_versions_manifest(args.manifest)
+
     # Check for uninstall or information flags and react appropriately
-    if args.uninstall:
+    if args.uninstall and batch:
+        results = spark_uninstall_batch(batch, args.jobs)
+        fmt = "{:>8}| {:>8}| {:<}"
+        print(fmt.format("Spark", "Hadoop", "Status"))
+        for job in results:
+            print(fmt.format(job["spark"], job["hadoop"] or "-", job["status"]))
+    elif args.uninstall:
         if args.spark_version and args.hadoop_version:
             spark_uninstall(args.spark_version, args.hadoop_version)
         else:
             logging.critical("Spark and Hadoop versions must be specified for uninstallation. Use -i to view installed versions.")
+    elif args.dedup and not (args.spark_version or args.hadoop_version or batch):
+        stats = spark_dedup()
+        print("Deduplicated %d of %d files, saving %d bytes" % (stats["linked"], stats["files"], stats["saved_bytes"]))
+    elif args.activate:
+        activated = spark_activate(args.spark_version, args.hadoop_version)
+        fmt = "set %s=%s" if sys.platform == "win32" else "export %s=\"%s\""
+        print(fmt % ("SPARK_HOME", activated["spark_home"]))
+        print(fmt % ("PYTHONPATH", os.environ.get("PYTHONPATH", "")))
     elif args.information:
         installedversions = list(spark_installed_versions())
         fmt = "{:>8}| {:>8}| {:<}"
@@ -389,12 +2577,30 @@ def main():
         for elem in installedversions:
             print(fmt.format(elem["spark"], elem["hadoop"], elem["dir"]))
     else:
-        # Verify that Java 1.8 is running on the system and if it is, run the install.
-        if _verify_java():
+        # Verify that a Java supported by the requested Spark versions is available and if it is, run the install.
+        if batch:
+            target_versions = [spark_version for spark_version, _ in batch]
+        else:
+            target_versions = [spark_install_find(args.spark_version, args.hadoop_version, installed_only=False)["spark"]]
+        if _verify_java(target_versions):
             logging.debug("Prerequisites checked successfully, running installation.")
             logging.debug("Spark Version: %s" % args.spark_version)
             logging.debug("Hadoop Version: %s" % args.hadoop_version)
-            spark_install(args.spark_version, args.hadoop_version, True, "INFO")
+            if batch:
+                results = spark_install_batch(batch, True, "INFO", args.cache_dir, args.jobs, args.dedup, repack=args.repack)
+                fmt = "{:>8}| {:>8}| {:>10}| {:>9}| {:>9}| {:>9}| {:>9}"
+                print(fmt.format("Spark", "Hadoop", "Status", "Download", "Extract", "Configure", "Total"))
+                for job in results:
+                    print(fmt.format(job["spark"], job["hadoop"], job["status"],
+                                     *["%.2fs" % job[k] if k in job else "-" for k in ("download", "extract", "configure", "total")]))
+            elif args.upgrade_from:
+                from_spark, from_hadoop = _parse_version_pairs([args.upgrade_from])[0]
+                stats = spark_upgrade(from_spark, from_hadoop, args.spark_version, args.hadoop_version, cache_dir=args.cache_dir)
+                print("Reused %d of %d files, fetched %d bytes" % (stats["reused"], stats["files"], stats["fetched_bytes"]))
+            else:
+                profile = spark_install_profile(args.profile, args.include and args.include.split(","), args.exclude and args.exclude.split(","))
+                spark_install(args.spark_version, args.hadoop_version, True, "INFO", args.stream, args.keep_archive, args.cache_dir, args.dedup,
+                              profile=profile, repack=args.repack)
             logging.debug("Completed the install")
         else:
             logging.critical("A prerequisite for installation has not been satisfied. Please check output log for details.")
@@ -0,0 +1,173 @@
+import os
+import time
+import asyncio
+import logging
+import functools
+import threading
+
+import spark_install
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+LOCK_POLL_INTERVAL = 0.1
+
+
+class SparkInstallProgress(object):
+    # Async iterator over the metrics events of one install. It ends once the install finishes,
+    # whether it succeeded, failed or was cancelled.
+    def __init__(self):
+        self._loop = None
+        self._queue = None
+
+    def _attach(self):
+        # Bound to the running loop on first use, from either the install or the consumer
+        if self._queue is None:
+            self._loop = asyncio.get_event_loop()
+            self._queue = asyncio.Queue()
+
+    def _callback(self, event):
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, event)
+
+    def _close(self):
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        self._attach()
+        event = await self._queue.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+
+async def _run(func, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+async def _run_cancellable(event, func, *args, **kwargs):
+    # Executor threads can't be interrupted, so a cancelled task sets event and waits for the
+    # worker to notice, clean up its partial files and return before the cancellation propagates
+    future = asyncio.ensure_future(_run(func, *args, **kwargs))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        event.set()
+        try:
+            await future
+        except Exception:
+            pass
+        raise
+
+
+async def _acquire(lock):
+    # Polls from the loop rather than waiting in an executor thread: tasks waiting for the lock
+    # would otherwise take the threads the task holding it needs to finish
+    deadline = time.time() + lock.timeout
+    while not lock.acquire(False):
+        if time.time() >= deadline:
+            raise IOError("Timed out waiting for %s" % lock.path)
+        await asyncio.sleep(LOCK_POLL_INTERVAL)
+    return lock
+
+
+def _write_blocks(f, hashers, blocks):
+    for block in blocks:
+        f.write(block)
+        for hasher in hashers.values():
+            hasher.update(block)
+
+
+async def _aiohttp_download(session, url, part_file, hashers, progress):
+    # Network reads stay on the event loop; writes and hashing are batched into the executor
+    done, blocks = 0, []
+    async with session.get(url) as response:
+        response.raise_for_status()
+        size = response.content_length
+        with open(part_file, "wb") as f:
+            async for block in response.content.iter_chunked(spark_install.DOWNLOAD_BLOCK_SIZE):
+                blocks.append(block)
+                done += len(block)
+                if done % spark_install.DOWNLOAD_CHUNK_SIZE < len(block):
+                    await _run(_write_blocks, f, hashers, blocks)
+                    blocks = []
+                    progress(done, size)
+            await _run(_write_blocks, f, hashers, blocks)
+    progress(done, size)
+    if size is not None and done != size:
+        raise IOError("Incomplete download of %s" % url)
+
+
+async def _aiohttp_fetch(info, cache_dir=None, metrics=None):
+    # Like _spark_install_fetch(), a repacked tar or a cached archive makes the download unnecessary
+    if await _run(spark_install._spark_install_repacked, info) or await _run(spark_install._spark_install_cached, info, cache_dir):
+        return
+    urls = await _run(spark_install.spark_mirrors_rank, [info["package_remote_path"]] + info["package_mirrors"])
+    part_file = info["package_local_path"] + ".part"
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=spark_install.DOWNLOAD_TIMEOUT)
+    with spark_install.spark_metrics_phase("download", metrics, spark=info["spark"], hadoop=info["hadoop"], url=urls[0]) as phase:
+        try:
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                for i, url in enumerate(urls):
+                    hashers = spark_install._digest_hashers(info["digest"])
+                    try:
+                        await _aiohttp_download(session, url, part_file, hashers, spark_install._metrics_progress(phase, metrics))
+                        break
+                    except (aiohttp.ClientError, asyncio.TimeoutError, IOError) as e:
+                        if i + 1 == len(urls):
+                            raise
+                        logging.warning("Download from %s failed, trying %s: %s" % (url, urls[i + 1], e))
+                        await _run(spark_install._mirrors_demote, url)
+            digests = dict((a, h.hexdigest()) for a, h in hashers.items())
+            spark_install._digest_check(info["digest"], digests, url)
+        except BaseException:
+            if os.path.isfile(part_file):
+                os.remove(part_file)
+            raise
+        phase["source"] = "network"
+        spark_install._replace_file(part_file, info["package_local_path"])
+        spark_install._digest_record(info["package_local_path"], digests)
+    if cache_dir:
+        await _run(spark_install.spark_cache_put, info["package_name"], info["package_local_path"], cache_dir, digest=digests["sha256"])
+
+
+async def async_spark_versions(connecting=False):
+    return await _run(spark_install.spark_versions, connecting)
+
+
+async def async_spark_uninstall(spark_version, hadoop_version):
+    return await _run(spark_install.spark_uninstall, spark_version, hadoop_version)
+
+
+async def async_spark_install(spark_version=None, hadoop_version=None, reset=True, loglevel="INFO", stream=False, cache_dir=None, progress=None,
+                              profile=None):
+    # Downloads with aiohttp when it is installed and runs every blocking step in the default
+    # executor. Cancelling the task removes partially downloaded and extracted files.
+    cancel = threading.Event()
+    if progress is not None:
+        progress._attach()
+    try:
+        info = await _run(spark_install.spark_install_find, spark_version, hadoop_version, installed_only=False)
+        metrics = progress._callback if progress is not None else None
+        cache_dir = cache_dir or spark_install.spark_cache_dir()
+        if aiohttp is not None and not stream and not os.path.isdir(info["spark_version_dir"]):
+            await _run(spark_install.spark_can_install)
+            # Holds the same lock as spark_install() so concurrent installs never share a .part file
+            lock = await _acquire(spark_install._spark_install_lock(info["spark_version_dir"]))
+            try:
+                # Another task or process may have installed this version while we waited
+                if not os.path.isdir(info["spark_version_dir"]):
+                    await _aiohttp_fetch(info, cache_dir, metrics)
+            finally:
+                lock.__exit__(None, None, None)
+        await _run_cancellable(cancel, spark_install.spark_install, info["spark"], info["hadoop"], reset=reset, loglevel=loglevel,
+                               stream=stream, cache_dir=cache_dir, metrics=metrics, cancel=cancel, profile=profile)
+    finally:
+        if progress is not None:
+            progress._close()
+    return info
@@ -3,6 +3,12 @@ import subprocess
 import spark_install
 import sys
 import os
+import re
+import hashlib
+import shutil
+import tempfile
+import time
+from bench_spark_install import serve_directory, make_spark_archive, run_benchmarks, compare_benchmarks
 
 class TestSparkInstall(unittest.TestCase):
     def setUp(self):
@@ -36,6 +42,778 @@ class TestSparkInstall(unittest.TestCase):
             raise ValueError("Error, Product detected as still installed.")
 
 
+class _LocalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.served = os.path.join(self.tmpdir, "served")
+        os.makedirs(self.served)
+        self.server = serve_directory(self.served)
+        self.install_dir = os.path.join(self.tmpdir, "spark")
+        os.makedirs(self.install_dir)
+        self.environ = dict(os.environ)
+        os.environ["SPARK_INSTALL_DIR"] = self.install_dir
+        os.environ["SPARK_INSTALL_MIRRORS"] = ""
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def serve_bytes(self, name, data):
+        with open(os.path.join(self.served, name), "wb") as f:
+            f.write(data)
+        return self.server.url + name
+
+    def serve_spark(self, spark_version, hadoop_version, extra_files=None):
+        package = "spark-%s-bin-hadoop%s.tgz" % (spark_version, hadoop_version)
+        component = make_spark_archive(os.path.join(self.served, package), spark_version, hadoop_version, extra_files)
+        self.write_catalog([{"spark": spark_version, "hadoop": hadoop_version}])
+        return component
+
+    def write_catalog(self, versions):
+        import json
+        entries = [dict({"base": self.server.url, "pattern": "spark-%s-bin-hadoop%s.tgz"}, **v) for v in versions]
+        with open(os.path.join(self.install_dir, "versions.json"), "w") as f:
+            json.dump(entries, f)
+
+
+class TestDownload(_LocalTestCase):
+    def setUp(self):
+        super(TestDownload, self).setUp()
+        self.payload = os.urandom(10 * 1024 + 123)
+        self.url = self.serve_bytes("archive.tgz", self.payload)
+        self.target = os.path.join(self.tmpdir, "archive.tgz")
+
+    def read_target(self):
+        with open(self.target, "rb") as f:
+            return f.read()
+
+    def test_ranged_download(self):
+        spark_install._download_file(self.url, self.target, threads=4, chunk_size=1024)
+        self.assertEqual(self.read_target(), self.payload)
+        self.assertEqual(len([r for r in self.server.requests if r[1] != "bytes=0-0"]), 11)
+        self.assertFalse(os.path.exists(self.target + ".part"))
+        self.assertFalse(os.path.exists(self.target + ".state"))
+
+    def test_single_stream_fallback(self):
+        self.server.ranges = False
+        spark_install._download_file(self.url, self.target, threads=4, chunk_size=1024)
+        self.assertEqual(self.read_target(), self.payload)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_resume_after_interruption(self):
+        self.server.fail_offsets.add(4096)
+        with self.assertRaises(Exception):
+            spark_install._download_file(self.url, self.target, threads=2, chunk_size=1024)
+        self.assertFalse(os.path.exists(self.target))
+        self.assertTrue(os.path.exists(self.target + ".state"))
+
+        self.server.fail_offsets.clear()
+        self.server.requests[:] = []
+        spark_install._download_file(self.url, self.target, threads=2, chunk_size=1024)
+        self.assertEqual(self.read_target(), self.payload)
+        self.assertEqual([r[1] for r in self.server.requests], ["bytes=0-0", "bytes=4096-5119"])
+
+
+class TestMirrors(_LocalTestCase):
+    def setUp(self):
+        super(TestMirrors, self).setUp()
+        self.mirror = serve_directory(self.served)
+        self.payload = os.urandom(10 * 1024 + 123)
+        self.primary_url = self.serve_bytes("archive.tgz", self.payload)
+        self.mirror_url = self.mirror.url + "archive.tgz"
+        self.target = os.path.join(self.tmpdir, "archive.tgz")
+
+    def tearDown(self):
+        self.mirror.shutdown()
+        self.mirror.server_close()
+        super(TestMirrors, self).tearDown()
+
+    def test_mirrors_from_catalog_and_environment(self):
+        os.environ["SPARK_INSTALL_MIRRORS"] = "https://example.org/spark-{spark}/"
+        self.write_catalog([{"spark": "2.1.1", "hadoop": "2.7", "mirrors": [self.mirror.url]}])
+        info = spark_install.spark_install_info("2.1.1", "2.7")
+        self.assertEqual(info["package_mirrors"], [self.mirror.url + "spark-2.1.1-bin-hadoop2.7.tgz",
+                                                   "https://example.org/spark-2.1.1/spark-2.1.1-bin-hadoop2.7.tgz"])
+
+    def test_ranking_is_cached_and_puts_failed_hosts_last(self):
+        dead = "http://127.0.0.1:1/archive.tgz"
+        self.assertEqual(spark_install.spark_mirrors_rank([dead, self.primary_url]), [self.primary_url, dead])
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(spark_install.spark_mirrors_rank([dead, self.primary_url]), [self.primary_url, dead])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_probe_reads_only_the_probe_size_without_ranges(self):
+        from unittest import mock
+        self.server.ranges = False
+        self.serve_bytes("large.tgz", os.urandom(4 * spark_install.MIRROR_PROBE_SIZE))
+        reads = []
+        urlopen = spark_install._urlopen
+
+        def counting_urlopen(*args, **kwargs):
+            response = urlopen(*args, **kwargs)
+            read = response.read
+
+            def counting_read(*read_args):
+                data = read(*read_args)
+                reads.append(len(data))
+                return data
+            response.read = counting_read
+            return response
+
+        with mock.patch.object(spark_install, "_urlopen", counting_urlopen):
+            self.assertFalse(spark_install._mirror_probe(self.server.url + "large.tgz").get("failed"))
+        self.assertEqual(sum(reads), spark_install.MIRROR_PROBE_SIZE)
+
+    def test_failover_keeps_fetched_chunks(self):
+        import time
+        spark_install._mirrors_update({self.server.url.rstrip("/"): {"seconds": 0.01, "checked": time.time()},
+                                       self.mirror.url.rstrip("/"): {"seconds": 0.5, "checked": time.time()}})
+        self.server.fail_offsets.add(4096)
+        spark_install._download_file(self.primary_url, self.target, threads=1, chunk_size=1024, mirrors=[self.mirror_url])
+        with open(self.target, "rb") as f:
+            self.assertEqual(f.read(), self.payload)
+        fetched = [r for _, r in self.mirror.requests]
+        self.assertEqual(fetched[0], "bytes=4096-5119")
+        self.assertNotIn("bytes=0-1023", fetched)
+        self.assertEqual(spark_install.spark_mirrors_rank([self.primary_url, self.mirror_url]), [self.mirror_url, self.primary_url])
+
+
+class TestStreamingInstall(_LocalTestCase):
+    def test_stream_install_without_archive(self):
+        component = self.serve_spark("2.1.1", "2.7")
+        spark_install.spark_install("2.1.1", "2.7", stream=True)
+        version_dir = os.path.join(self.install_dir, component)
+        self.assertTrue(os.path.isfile(os.path.join(version_dir, "jars", "spark-core.jar")))
+        self.assertTrue(os.path.isfile(os.path.join(version_dir, "conf", "log4j.properties")))
+        self.assertFalse(os.path.exists(os.path.join(self.install_dir, component + ".tgz")))
+
+    def test_stream_install_tees_archive(self):
+        component = self.serve_spark("2.1.1", "2.7")
+        spark_install.spark_install("2.1.1", "2.7", stream=True, keep_archive=True)
+        with open(os.path.join(self.install_dir, component + ".tgz"), "rb") as kept:
+            with open(os.path.join(self.served, component + ".tgz"), "rb") as served:
+                self.assertEqual(kept.read(), served.read())
+
+
+class TestArchiveCache(_LocalTestCase):
+    def setUp(self):
+        super(TestArchiveCache, self).setUp()
+        self.cache_dir = os.path.join(self.tmpdir, "cache")
+
+    def test_second_install_uses_cache(self):
+        component = self.serve_spark("2.1.1", "2.7")
+        spark_install.spark_install("2.1.1", "2.7", cache_dir=self.cache_dir)
+
+        first_dir = self.install_dir
+        self.install_dir = os.path.join(self.tmpdir, "spark-other")
+        os.makedirs(self.install_dir)
+        os.environ["SPARK_INSTALL_DIR"] = self.install_dir
+        self.write_catalog([{"spark": "2.1.1", "hadoop": "2.7"}])
+        self.server.requests[:] = []
+
+        spark_install.spark_install("2.1.1", "2.7", cache_dir=self.cache_dir)
+        self.assertEqual(self.server.requests, [])
+        self.assertTrue(os.path.isdir(os.path.join(self.install_dir, component)))
+        self.assertEqual(os.stat(os.path.join(first_dir, component + ".tgz")).st_ino,
+                         os.stat(os.path.join(self.install_dir, component + ".tgz")).st_ino)
+
+    def test_least_recently_used_evicted(self):
+        for name in ("a.tgz", "b.tgz", "c.tgz"):
+            path = os.path.join(self.tmpdir, name)
+            with open(path, "wb") as f:
+                f.write(os.urandom(1000))
+            spark_install.spark_cache_put(name, path, self.cache_dir, max_size=2500)
+        self.assertTrue(spark_install.spark_cache_get("a.tgz", os.path.join(self.tmpdir, "a2.tgz"), self.cache_dir) is None)
+        self.assertTrue(spark_install.spark_cache_get("c.tgz", os.path.join(self.tmpdir, "c2.tgz"), self.cache_dir))
+
+    def test_cache_is_group_writable(self):
+        import stat
+        path = os.path.join(self.tmpdir, "a.tgz")
+        with open(path, "wb") as f:
+            f.write(b"archive")
+        umask = os.umask(0o022)
+        try:
+            digest = spark_install.spark_cache_put("a.tgz", path, self.cache_dir)
+        finally:
+            os.umask(umask)
+        for relative in ("", "objects", os.path.join("objects", digest[:2]), "index.json", ".lock"):
+            mode = os.stat(os.path.join(self.cache_dir, relative)).st_mode
+            self.assertTrue(mode & stat.S_IWGRP, relative)
+
+        # Another user can only read the lock file
+        os.chmod(os.path.join(self.cache_dir, ".lock"), 0o444)
+        self.assertTrue(spark_install.spark_cache_get("a.tgz", os.path.join(self.tmpdir, "a2.tgz"), self.cache_dir))
+
+
+class TestChecksum(_LocalTestCase):
+    def serve_spark_with_digest(self, digest=None):
+        import hashlib
+        component = self.serve_spark("2.1.1", "2.7")
+        with open(os.path.join(self.served, component + ".tgz"), "rb") as f:
+            digest = digest or "sha512:" + hashlib.sha512(f.read()).hexdigest()
+        self.write_catalog([{"spark": "2.1.1", "hadoop": "2.7", "digest": digest}])
+        return component
+
+    def test_matching_digest_is_recorded(self):
+        component = self.serve_spark_with_digest()
+        spark_install.spark_install("2.1.1", "2.7")
+        archive = os.path.join(self.install_dir, component + ".tgz")
+        self.assertIn("sha512", spark_install._digest_recorded(archive))
+        self.assertTrue(os.path.isdir(os.path.join(self.install_dir, component)))
+
+    def test_mismatch_rejected_before_extraction(self):
+        component = self.serve_spark_with_digest("sha256:" + "0" * 64)
+        with self.assertRaises(IOError):
+            spark_install.spark_install("2.1.1", "2.7")
+        self.assertFalse(os.path.exists(os.path.join(self.install_dir, component)))
+        self.assertFalse(os.path.exists(os.path.join(self.install_dir, component + ".tgz")))
+
+    def test_corrupt_cached_archive_is_downloaded_again(self):
+        component = self.serve_spark_with_digest()
+        with open(os.path.join(self.install_dir, component + ".tgz"), "wb") as f:
+            f.write(b"truncated")
+        spark_install.spark_install("2.1.1", "2.7")
+        self.assertTrue(os.path.isdir(os.path.join(self.install_dir, component)))
+
+
+class TestVersionCatalog(_LocalTestCase):
+    def setUp(self):
+        super(TestVersionCatalog, self).setUp()
+        self.write_catalog([{"spark": "2.1.1", "hadoop": "2.7"}, {"spark": "2.2.0", "hadoop": "2.7"}])
+        spark_install._versions_meta_save(os.path.join(self.install_dir, "versions.json"), {"checked": time.time()})
+
+    def test_lookups_reuse_loaded_catalog(self):
+        import json
+        from unittest import mock
+        spark_install.spark_default_version()
+        with mock.patch("json.load", wraps=json.load) as load, mock.patch("os.listdir", wraps=os.listdir) as listdir, \
+                mock.patch.object(spark_install, "spark_can_install") as can_install:
+            for i in range(10):
+                spark_install.spark_install_info("2.1.1", "2.7")
+                spark_install.spark_install_find("2.2.0", installed_only=False)
+                spark_install.spark_default_version()
+        self.assertEqual(load.call_count, 0)
+        self.assertEqual(listdir.call_count, 0)
+        self.assertEqual(can_install.call_count, 0)
+
+    def test_catalog_follows_file_and_install_dir_changes(self):
+        self.assertEqual(spark_install.spark_default_version(), {"spark": "2.2.0", "hadoop": "2.7"})
+        os.makedirs(os.path.join(self.install_dir, "spark-2.1.1-bin-hadoop2.7"))
+        self.assertEqual(spark_install.spark_default_version(), {"spark": "2.1.1", "hadoop": "2.7"})
+
+        self.write_catalog([{"spark": "2.1.1", "hadoop": "2.7"}, {"spark": "2.3.0", "hadoop": "2.7"}])
+        os.utime(os.path.join(self.install_dir, "versions.json"), (0, 0))
+        self.assertEqual(spark_install.spark_install_find("2.3.0", installed_only=False)["spark"], "2.3.0")
+        with self.assertRaises(ValueError):
+            spark_install.spark_versions_info("2.2.0", "2.7")
+
+
+class TestVersionsRefresh(_LocalTestCase):
+    def setUp(self):
+        super(TestVersionsRefresh, self).setUp()
+        self.versions_url = spark_install.SPARK_VERSIONS_URL
+        spark_install.SPARK_VERSIONS_URL = self.serve_bytes("versions.json", b'[{"spark": "2.1.1", "hadoop": "2.7", "base": "", "pattern": ""}]')
+
+    def tearDown(self):
+        spark_install.SPARK_VERSIONS_URL = self.versions_url
+        super(TestVersionsRefresh, self).tearDown()
+
+    def test_conditional_refresh(self):
+        self.assertEqual(len(spark_install.spark_versions_initialize()), 1)
+        self.assertEqual(len(spark_install.spark_versions_initialize()), 1)
+        self.assertEqual(len(self.server.requests), 1)
+
+        mtime = os.stat(os.path.join(self.install_dir, "versions.json")).st_mtime
+        spark_install.spark_versions_initialize(connecting=True)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(os.stat(os.path.join(self.install_dir, "versions.json")).st_mtime, mtime)
+
+    def test_ttl_expiry_and_offline_fallback(self):
+        spark_install.spark_versions_initialize()
+        os.environ["SPARK_VERSIONS_TTL_DAYS"] = "0"
+        self.serve_bytes("versions.json", b'[]')
+        self.assertEqual(spark_install.spark_versions_initialize(), [])
+
+        self.server.shutdown()
+        self.server.server_close()
+        self.serve_bytes("versions.json", b'[{"spark": "9.9.9"}]')
+        self.assertEqual(spark_install.spark_versions_initialize(connecting=True), [])
+
+
+class TestBatchInstall(_LocalTestCase):
+    def test_batch_install_and_uninstall(self):
+        versions = [{"spark": "2.1.1", "hadoop": "2.7"}, {"spark": "2.2.0", "hadoop": "2.7"}, {"spark": "2.2.0", "hadoop": "2.6"}]
+        for v in versions:
+            make_spark_archive(os.path.join(self.served, "spark-%s-bin-hadoop%s.tgz" % (v["spark"], v["hadoop"])), v["spark"], v["hadoop"])
+        self.write_catalog(versions)
+
+        results = spark_install.spark_install_batch(["2.1.1:2.7", "2.2.0:2.7", ("2.2.0", "2.6"), "2.1.1:2.7"], max_downloads=2)
+        self.assertEqual([(r["spark"], r["hadoop"], r["status"]) for r in results],
+                         [("2.1.1", "2.7", "installed"), ("2.2.0", "2.7", "installed"), ("2.2.0", "2.6", "installed")])
+        for result in results:
+            self.assertTrue(set(["download", "extract", "configure", "total"]) <= set(result))
+        self.assertEqual(len(spark_install.spark_installed_versions()), 3)
+
+        results = spark_install.spark_uninstall_batch(["2.1.1", "2.2.0:2.6", "9.9.9:2.7", "1.6.0"])
+        self.assertEqual([(r["spark"], r["hadoop"], r["status"]) for r in results],
+                         [("2.1.1", "2.7", "uninstalled"), ("2.2.0", "2.6", "uninstalled"), ("9.9.9", "2.7", "failed"), ("1.6.0", None, "failed")])
+        self.assertEqual([(v["spark"], v["hadoop"]) for v in spark_install.spark_installed_versions()], [("2.2.0", "2.7")])
+
+
+class TestInstallLock(_LocalTestCase):
+    def test_concurrent_installs_share_one_download(self):
+        import threading
+        component = self.serve_spark("2.1.1", "2.7", {"jars/large.jar": os.urandom(1024 * 1024)})
+        self.server.throttle = 0.05
+        errors = []
+
+        def install():
+            try:
+                spark_install.spark_install("2.1.1", "2.7")
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=install) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        fetched = [r for path, r in self.server.requests if path.endswith(".tgz") and r != "bytes=0-0"]
+        self.assertEqual(len(fetched), 1)
+        self.assertEqual(sorted(os.listdir(self.install_dir)), sorted([component, component + ".tgz", component + ".tgz.digest", "versions.json"]))
+
+    def test_stale_lock_is_taken_over(self):
+        component = self.serve_spark("2.1.1", "2.7")
+        with open(os.path.join(self.install_dir, ".%s.lock" % component), "w") as f:
+            f.write("12345\n")
+        spark_install.spark_install("2.1.1", "2.7")
+        self.assertTrue(os.path.isdir(os.path.join(self.install_dir, component)))
+        self.assertFalse(os.path.exists(os.path.join(self.install_dir, ".%s.lock" % component)))
+
+    def test_versions_being_installed_are_hidden(self):
+        component = self.serve_spark("2.1.1", "2.7")
+        version_dir = os.path.join(self.install_dir, component)
+        os.makedirs(version_dir)
+        lock = spark_install._spark_install_lock(version_dir)
+        with lock:
+            self.assertEqual(spark_install.spark_installed_versions(), [])
+            timeout = spark_install.INSTALL_LOCK_TIMEOUT
+            spark_install.INSTALL_LOCK_TIMEOUT = 0.2
+            try:
+                shutil.rmtree(version_dir)
+                with self.assertRaises(IOError):
+                    spark_install.spark_install("2.1.1", "2.7")
+            finally:
+                spark_install.INSTALL_LOCK_TIMEOUT = timeout
+            os.makedirs(version_dir)
+        self.assertEqual([v["dir"] for v in spark_install.spark_installed_versions()], [version_dir])
+
+
+class TestProfiles(_LocalTestCase):
+    def setUp(self):
+        super(TestProfiles, self).setUp()
+        self.component = self.serve_spark("2.1.1", "2.7", {"R/lib/SparkR/DESCRIPTION": b"Package: SparkR\n",
+                                                           "examples/src/main/python/pi.py": b"print(3.14)\n",
+                                                           "data/mllib/sample.txt": b"1 2 3\n"})
+        self.version_dir = os.path.join(self.install_dir, self.component)
+
+    def installed_files(self):
+        return sorted(os.path.relpath(os.path.join(root, name), self.version_dir).replace(os.sep, "/")
+                      for root, _, files in os.walk(self.version_dir) for name in files if not name.startswith("."))
+
+    def test_python_minimal_then_full(self):
+        spark_install.spark_install("2.1.1", "2.7", profile="python-minimal")
+        self.assertFalse(os.path.exists(os.path.join(self.version_dir, "R")))
+        self.assertFalse(os.path.exists(os.path.join(self.version_dir, "examples")))
+        self.assertIn("python/lib/pyspark.zip", self.installed_files())
+        jar = os.path.join(self.version_dir, "jars", "spark-core.jar")
+        inode = os.stat(jar).st_ino
+
+        spark_install.spark_install("2.1.1", "2.7", profile="full")
+        self.assertIn("R/lib/SparkR/DESCRIPTION", self.installed_files())
+        self.assertIn("examples/src/main/python/pi.py", self.installed_files())
+        self.assertEqual(os.stat(jar).st_ino, inode)
+        self.assertFalse(os.path.exists(os.path.join(self.version_dir, ".spark-install.json")))
+
+    def test_custom_globs(self):
+        profile = spark_install.spark_install_profile(include=["conf/*", "jars/*", "python/*"], exclude=["python/lib/py4j*"])
+        spark_install.spark_install("2.1.1", "2.7", profile=profile)
+        self.assertEqual([f for f in self.installed_files() if not f.startswith("conf/")],
+                         ["jars/spark-core.jar", "python/lib/pyspark.zip"])
+        with self.assertRaises(ValueError):
+            spark_install.spark_install_profile("tiny")
+
+
+class TestWinutils(_LocalTestCase):
+    def setUp(self):
+        super(TestWinutils, self).setUp()
+        import zipfile
+        self.binaries = dict(("winutils-master/hadoop-%s/bin/%s" % (v, name), os.urandom(64 * 1024))
+                             for v in ("2.6.0", "2.7.1", "3.0.0") for name in ("winutils.exe", "hadoop.dll"))
+        self.zip_path = os.path.join(self.served, "master.zip")
+        with zipfile.ZipFile(self.zip_path, "w") as zf:
+            for name, data in sorted(self.binaries.items()):
+                zf.writestr(name, data)
+        self.winutils_url = spark_install.WINUTILS_URL
+        spark_install.WINUTILS_URL = self.server.url + "master.zip"
+
+    def tearDown(self):
+        spark_install.WINUTILS_URL = self.winutils_url
+        super(TestWinutils, self).tearDown()
+
+    def assert_only_hadoop_27(self, spark_dir):
+        home = os.path.join(spark_dir, "winutils-master", "hadoop-2.7.1")
+        self.assertEqual(os.environ["HADOOP_HOME"], home)
+        self.assertEqual(os.listdir(os.path.join(spark_dir, "winutils-master")), ["hadoop-2.7.1"])
+        with open(os.path.join(home, "bin", "winutils.exe"), "rb") as f:
+            self.assertEqual(f.read(), self.binaries["winutils-master/hadoop-2.7.1/bin/winutils.exe"])
+
+    def test_ranged_extraction_of_one_hadoop_version(self):
+        spark_install.spark_install_winutils(self.install_dir, "2.7")
+        self.assert_only_hadoop_27(self.install_dir)
+        self.assertFalse(os.path.exists(os.path.join(self.install_dir, "winutils-master.zip")))
+        ranges = [re.match(r"bytes=(\d+)-(\d+)", r).groups() for _, r in self.server.requests]
+        fetched = sum(int(end) - int(start) + 1 for start, end in ranges)
+        self.assertLess(fetched, os.path.getsize(self.zip_path) // 2)
+
+    def test_full_download_is_cached_across_spark_dirs(self):
+        self.server.ranges = False
+        os.environ["SPARK_INSTALL_CACHE_DIR"] = os.path.join(self.tmpdir, "cache")
+        spark_install.spark_install_winutils(self.install_dir, "2.7")
+        self.assert_only_hadoop_27(self.install_dir)
+
+        other_dir = os.path.join(self.tmpdir, "other")
+        os.makedirs(other_dir)
+        del self.server.requests[:]
+        spark_install.spark_install_winutils(other_dir, "2.7")
+        self.assert_only_hadoop_27(other_dir)
+        self.assertEqual(self.server.requests, [])
+
+
+class TestRepack(_LocalTestCase):
+    def test_reinstall_from_repacked_archive(self):
+        files = dict(("jars/lib-%d.jar" % i, os.urandom(4096)) for i in range(20))
+        component = self.serve_spark("2.1.1", "2.7", files)
+        spark_install.spark_install("2.1.1", "2.7", repack=True)
+        tar_path = os.path.join(self.install_dir, component + ".tar")
+        self.assertTrue(os.path.isfile(tar_path + ".manifest.json"))
+        self.assertFalse(os.path.exists(os.path.join(self.install_dir, component + ".tgz")))
+
+        spark_install.spark_uninstall("2.1.1", "2.7")
+        del self.server.requests[:]
+        events = []
+        spark_install.spark_install("2.1.1", "2.7", metrics=events.append)
+        self.assertEqual(self.server.requests, [])
+        self.assertIn("repacked", [e.get("source") for e in events if e["phase"] == "extract" and e["event"] == "end"])
+        version_dir = os.path.join(self.install_dir, component)
+        for name, data in files.items():
+            with open(os.path.join(version_dir, name), "rb") as f:
+                self.assertEqual(f.read(), data)
+        self.assertTrue(os.access(os.path.join(version_dir, "bin", "spark-submit"), os.X_OK))
+
+    def test_repacked_archive_is_ignored_when_the_digest_changes(self):
+        component = self.serve_spark("2.1.1", "2.7")
+        spark_install.spark_install("2.1.1", "2.7", repack=True)
+        spark_install.spark_uninstall("2.1.1", "2.7")
+        with open(os.path.join(self.served, component + ".tgz"), "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        self.write_catalog([{"spark": "2.1.1", "hadoop": "2.7", "digest": "sha256:" + "0" * 64}])
+        info = spark_install.spark_install_find("2.1.1", "2.7", installed_only=False)
+        self.assertIsNone(spark_install._spark_install_repacked(info))
+        self.write_catalog([{"spark": "2.1.1", "hadoop": "2.7", "digest": "sha256:" + digest}])
+        info = spark_install.spark_install_find("2.1.1", "2.7", installed_only=False)
+        self.assertIsNotNone(spark_install._spark_install_repacked(info))
+
+
+class TestDedup(_LocalTestCase):
+    def test_dedup_and_reference_counted_uninstall(self):
+        shared = {"jars/shared.jar": b"x" * 8192}
+        versions = [{"spark": "2.1.1", "hadoop": "2.7"}, {"spark": "2.2.0", "hadoop": "2.7"}]
+        for v in versions:
+            make_spark_archive(os.path.join(self.served, "spark-%s-bin-hadoop%s.tgz" % (v["spark"], v["hadoop"])),
+                                v["spark"], v["hadoop"], dict(shared, **{"jars/own.jar": os.urandom(8192)}))
+        self.write_catalog(versions)
+        spark_install.spark_install("2.1.1", "2.7")
+        spark_install.spark_install("2.2.0", "2.7", dedup=True)
+
+        first = os.path.join(self.install_dir, "spark-2.1.1-bin-hadoop2.7", "jars")
+        second = os.path.join(self.install_dir, "spark-2.2.0-bin-hadoop2.7", "jars")
+        self.assertEqual(os.stat(os.path.join(first, "shared.jar")).st_ino, os.stat(os.path.join(second, "shared.jar")).st_ino)
+        self.assertNotEqual(os.stat(os.path.join(first, "own.jar")).st_ino, os.stat(os.path.join(second, "own.jar")).st_ino)
+
+        spark_install.spark_uninstall("2.1.1", "2.7")
+        with open(os.path.join(second, "shared.jar"), "rb") as f:
+            self.assertEqual(f.read(), shared["jars/shared.jar"])
+        self.assertEqual(spark_install.spark_dedup_gc(), 0)
+        spark_install.spark_uninstall("2.2.0", "2.7")
+        objects = [f for _, _, files in os.walk(os.path.join(self.install_dir, ".objects")) for f in files]
+        self.assertEqual(objects, [".lock"])
+
+
+class TestUpgrade(_LocalTestCase):
+    def setUp(self):
+        super(TestUpgrade, self).setUp()
+        self.shared = dict(("jars/shared-%d.jar" % i, os.urandom(16384)) for i in range(8))
+        self.changed = os.urandom(16384)
+        make_spark_archive(os.path.join(self.served, "spark-2.1.1-bin-hadoop2.7.tar"), "2.1.1", "2.7",
+                           dict(self.shared, **{"jars/spark-sql.jar": os.urandom(16384)}), mode="w")
+        self.write_catalog([{"spark": "2.1.1", "hadoop": "2.7", "pattern": "spark-%s-bin-hadoop%s.tar"}])
+        spark_install.spark_install("2.1.1", "2.7")
+
+    def assert_upgraded(self):
+        old = os.path.join(self.install_dir, "spark-2.1.1-bin-hadoop2.7")
+        new = os.path.join(self.install_dir, "spark-2.1.2-bin-hadoop2.7")
+        with open(os.path.join(new, "jars", "spark-sql.jar"), "rb") as f:
+            self.assertEqual(f.read(), self.changed)
+        for name in self.shared:
+            self.assertEqual(os.stat(os.path.join(old, name)).st_ino, os.stat(os.path.join(new, name)).st_ino)
+        self.assertTrue(os.access(os.path.join(new, "bin", "spark-submit"), os.X_OK))
+        self.assertTrue(os.path.isfile(os.path.join(new, "conf", "log4j.properties")))
+
+    def test_upgrade_fetches_only_changed_members(self):
+        archive = os.path.join(self.served, "spark-2.1.2-bin-hadoop2.7.tar")
+        make_spark_archive(archive, "2.1.2", "2.7", dict(self.shared, **{"jars/spark-sql.jar": self.changed}), mode="w")
+        spark_install.spark_archive_manifest(archive)
+        self.write_catalog([{"spark": v, "hadoop": "2.7", "pattern": "spark-%s-bin-hadoop%s.tar"} for v in ("2.1.1", "2.1.2")])
+        del self.server.requests[:]
+
+        stats = spark_install.spark_upgrade("2.1.1", "2.7", "2.1.2")
+        self.assertEqual(stats["mode"], "ranged")
+        self.assertEqual(stats["reused"], stats["files"] - 1)
+        self.assertLess(stats["fetched_bytes"], os.path.getsize(archive) // 4)
+        self.assertTrue(all(r for path, r in self.server.requests if path.endswith(".tar")))
+        self.assert_upgraded()
+
+    def test_upgrade_with_digest_ignores_manifest(self):
+        archive = os.path.join(self.served, "spark-2.1.2-bin-hadoop2.7.tar")
+        make_spark_archive(archive, "2.1.2", "2.7", dict(self.shared, **{"jars/spark-sql.jar": self.changed}), mode="w")
+        spark_install.spark_archive_manifest(archive)
+        digest = "sha256:" + spark_install._file_digest(archive)
+        self.write_catalog([{"spark": "2.1.1", "hadoop": "2.7", "pattern": "spark-%s-bin-hadoop%s.tar"},
+                            {"spark": "2.1.2", "hadoop": "2.7", "pattern": "spark-%s-bin-hadoop%s.tar", "digest": digest}])
+        stats = spark_install.spark_upgrade("2.1.1", "2.7", "2.1.2")
+        self.assertEqual(stats["mode"], "stream")
+        self.assert_upgraded()
+
+    def test_upgrade_without_manifest_links_unchanged_members(self):
+        make_spark_archive(os.path.join(self.served, "spark-2.1.2-bin-hadoop2.7.tgz"), "2.1.2", "2.7",
+                           dict(self.shared, **{"jars/spark-sql.jar": self.changed}))
+        self.write_catalog([{"spark": "2.1.1", "hadoop": "2.7", "pattern": "spark-%s-bin-hadoop%s.tar"},
+                            {"spark": "2.1.2", "hadoop": "2.7"}])
+        stats = spark_install.spark_upgrade("2.1.1", "2.7", "2.1.2")
+        self.assertEqual(stats["mode"], "stream")
+        self.assertEqual(stats["reused"], stats["files"] - 1)
+        self.assert_upgraded()
+
+
+class TestActivation(_LocalTestCase):
+    def test_activate_without_catalog(self):
+        component = self.serve_spark("2.1.1", "2.7")
+        spark_install.spark_install("2.1.1", "2.7")
+        os.remove(os.path.join(self.install_dir, "versions.json"))
+        os.environ.pop("PYTHONPATH", None)
+        sys_path = list(sys.path)
+        try:
+            from unittest import mock
+            with mock.patch.object(spark_install, "_urlopen") as urlopen:
+                activated = spark_install.spark_activate()
+                with mock.patch("glob.glob") as glob:
+                    self.assertEqual(spark_install.spark_activate(), activated)
+                self.assertEqual(glob.call_count, 0)
+            self.assertEqual(urlopen.call_count, 0)
+        finally:
+            sys.path[:] = sys_path
+        self.assertEqual(activated["spark_home"], os.path.join(self.install_dir, component))
+        self.assertEqual(os.environ["SPARK_HOME"], activated["spark_home"])
+        self.assertEqual([os.path.basename(z) for z in activated["zipfiles"]], ["py4j-src.zip", "pyspark.zip"])
+        self.assertEqual(os.environ["PYTHONPATH"], os.pathsep.join(activated["zipfiles"]))
+        with self.assertRaises(RuntimeError):
+            spark_install.spark_activate("9.9.9")
+
+
+class TestConfig(_LocalTestCase):
+    def setUp(self):
+        super(TestConfig, self).setUp()
+        self.component = self.serve_spark("2.1.1", "2.7")
+        spark_install.spark_install("2.1.1", "2.7")
+        self.conf_dir = os.path.join(self.install_dir, self.component, "conf")
+        self.info = {"spark_conf_dir": self.conf_dir}
+
+    def read_conf(self, name):
+        with open(os.path.join(self.conf_dir, name)) as f:
+            return f.read()
+
+    def test_reinstall_leaves_unchanged_configs_alone(self):
+        stats = dict((name, os.stat(os.path.join(self.conf_dir, name))) for name in ("log4j.properties", "hive-site.xml"))
+        spark_install.spark_install("2.1.1", "2.7")
+        for name, stat in stats.items():
+            self.assertEqual(os.stat(os.path.join(self.conf_dir, name)).st_ino, stat.st_ino)
+        self.assertEqual(self.read_conf("log4j.properties").count("log4j.rootCategory="), 1)
+        self.assertNotIn("\n\n", self.read_conf("log4j.properties"))
+
+    def test_spark_defaults_with_spaces(self):
+        properties = {"spark.driver.extraJavaOptions": "-Dfoo=1 -Dbar=2"}
+        self.assertTrue(spark_install.spark_conf_file_set_value(self.info, properties, False))
+        self.assertFalse(spark_install.spark_conf_file_set_value(self.info, properties, False))
+        self.assertTrue(spark_install.spark_conf_file_set_value(self.info, {"spark.master": "local[4]"}, False))
+        content = self.read_conf("spark-defaults.conf")
+        self.assertIn("-Dfoo=1 -Dbar=2", content)
+        self.assertIn("local[4]", content)
+        self.assertTrue(content.startswith("# spark.master"))
+
+    def test_bulk_set_across_versions(self):
+        changed = spark_install.spark_config_set(log4j={"log4j.rootCategory": "WARN, console"},
+                                                 hive={"hive.exec.scratchdir": "/tmp/hive"})
+        self.assertEqual(sorted(os.path.basename(c) for c in changed), ["hive-site.xml", "log4j.properties"])
+        self.assertIn("javax.jdo.option.ConnectionURL", self.read_conf("hive-site.xml"))
+        self.assertEqual(spark_install.spark_config_set(log4j={"log4j.rootCategory": "WARN, console"}), [])
+
+    def test_rewrites_keep_the_file_mode(self):
+        defaults = os.path.join(self.conf_dir, "spark-defaults.conf")
+        spark_install.spark_conf_file_set_value(self.info, {"spark.master": "local[2]"}, False)
+        os.chmod(defaults, 0o600)
+        self.assertTrue(spark_install.spark_conf_file_set_value(self.info, {"spark.hadoop.fs.s3a.secret.key": "secret"}, False))
+        self.assertEqual(os.stat(defaults).st_mode & 0o777, 0o600)
+
+        hive_site = os.path.join(self.conf_dir, "hive-site.xml")
+        os.remove(hive_site)
+        umask = os.umask(0o077)
+        try:
+            spark_install.spark_hive_file_set_value(hive_site, {"javax.jdo.option.ConnectionPassword": "secret"})
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(hive_site).st_mode & 0o777, 0o600)
+
+
+class TestMetrics(_LocalTestCase):
+    def test_phase_events_and_jsonl_output(self):
+        import json
+        self.serve_spark("2.1.1", "2.7")
+        events = []
+        metrics_file = os.path.join(self.tmpdir, "metrics.jsonl")
+        writer = spark_install.spark_metrics_jsonl(metrics_file)
+        spark_install.spark_metrics_add(writer)
+        try:
+            spark_install.spark_install("2.1.1", "2.7", metrics=events.append)
+        finally:
+            spark_install.spark_metrics_remove(writer)
+
+        ended = dict((e["phase"], e) for e in events if e["event"] == "end")
+        self.assertEqual(sorted(ended), ["configure", "download", "env", "extract", "resolve"])
+        self.assertTrue(all(e["ok"] and e["spark"] == "2.1.1" for e in ended.values()))
+        archive_size = os.path.getsize(os.path.join(self.served, "spark-2.1.1-bin-hadoop2.7.tgz"))
+        self.assertEqual(ended["download"]["bytes"], archive_size)
+        self.assertTrue(ended["download"]["throughput"] > 0)
+        with open(metrics_file) as f:
+            self.assertEqual([json.loads(line) for line in f], events)
+
+    def test_concurrent_installs_keep_their_own_events(self):
+        import threading
+        versions = [{"spark": "2.1.1", "hadoop": "2.7"}, {"spark": "2.2.0", "hadoop": "2.7"}]
+        for v in versions:
+            make_spark_archive(os.path.join(self.served, "spark-%s-bin-hadoop%s.tgz" % (v["spark"], v["hadoop"])), v["spark"], v["hadoop"],
+                               {"jars/large.jar": os.urandom(256 * 1024)})
+        self.write_catalog(versions)
+        self.server.throttle = 0.01
+        events = dict((v["spark"], []) for v in versions)
+        threads = [threading.Thread(target=spark_install.spark_install, args=(v["spark"], v["hadoop"]),
+                                    kwargs={"metrics": events[v["spark"]].append}) for v in versions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for spark_version, received in events.items():
+            self.assertIn("extract", [e["phase"] for e in received if e["event"] == "end"])
+            self.assertEqual(set(e["spark"] for e in received), set([spark_version]))
+
+
+class TestJavaDiscovery(_LocalTestCase):
+    def make_jdk(self, version):
+        java_home = os.path.join(self.tmpdir, "jdk-" + version)
+        os.makedirs(os.path.join(java_home, "bin"))
+        java = os.path.join(java_home, "bin", "java")
+        with open(java, "w") as f:
+            f.write("#!/bin/sh\nexit 1\n")
+        os.chmod(java, 0o755)
+        with open(os.path.join(java_home, "release"), "w") as f:
+            f.write('IMPLEMENTOR="Test"\nJAVA_VERSION="%s"\n' % version)
+        os.environ["JAVA_HOME"] = java_home
+        return java
+
+    def test_release_file_and_cache(self):
+        from unittest import mock
+        java = self.make_jdk("1.8.0_181")
+        with mock.patch("subprocess.check_output") as check_output:
+            info = spark_install.spark_java_info()
+            with mock.patch.object(spark_install, "_java_release_version") as release:
+                self.assertEqual(spark_install.spark_java_info(), info)
+            self.assertEqual(release.call_count, 0)
+        self.assertEqual(check_output.call_count, 0)
+        self.assertEqual((info["path"], info["major"], info["source"]), (os.path.realpath(java), 8, "release"))
+
+    def test_compatibility_table(self):
+        self.make_jdk("11.0.2")
+        self.assertEqual(spark_install.spark_java_info()["major"], 11)
+        self.assertFalse(spark_install._verify_java(["2.4.3"]))
+        self.assertTrue(spark_install._verify_java(["3.0.0", "3.5.1"]))
+        self.assertEqual(spark_install._java_major("17"), 17)
+        self.assertEqual(spark_install.spark_java_supported("1.6.3"), [7, 8])
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_benchmark_reports_every_phase(self):
+        results = run_benchmarks([64 * 1024], [8], repeat=1)
+        self.assertEqual(len(results["results"]), 1)
+        self.assertEqual(sorted(results["results"][0]["phases"]),
+                         sorted(["catalog", "find", "download", "extract", "configure", "env"]))
+        rows = compare_benchmarks(results, results)
+        self.assertEqual(sorted(row["phase"] for row in rows), sorted(results["results"][0]["phases"]))
+        self.assertFalse(any(row["regression"] for row in rows))
+
+
+class TestExtraction(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.archive = os.path.join(self.tmpdir, "spark.tgz")
+        files = dict(("jars/lib-%d.jar" % i, os.urandom(2048)) for i in range(50))
+        self.component = make_spark_archive(self.archive, "2.1.1", "2.7", files)
+        self.files = files
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_parallel_extraction(self):
+        spark_install._extract_archive(self.archive, self.tmpdir, threads=4)
+        version_dir = os.path.join(self.tmpdir, self.component)
+        for name, data in self.files.items():
+            with open(os.path.join(version_dir, name), "rb") as f:
+                self.assertEqual(f.read(), data)
+        self.assertTrue(os.access(os.path.join(version_dir, "bin", "spark-submit"), os.X_OK))
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), sorted([self.component, "spark.tgz"]))
+
+    def test_failed_extraction_leaves_nothing_behind(self):
+        def crash():
+            raise IOError("simulated crash")
+        with self.assertRaises(IOError):
+            spark_install._extract_archive(self.archive, self.tmpdir, before_commit=crash)
+        self.assertEqual(os.listdir(self.tmpdir), ["spark.tgz"])
+
+    def test_cleanup_removes_only_abandoned_staging(self):
+        os.makedirs(os.path.join(self.tmpdir, ".extract-crashed", self.component))
+        staging, lock = spark_install._extract_staging(self.tmpdir)
+        try:
+            spark_install._extract_cleanup(self.tmpdir)
+            self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                             sorted([os.path.basename(staging), os.path.basename(staging) + ".lock", "spark.tgz"]))
+        finally:
+            spark_install._extract_release(staging, lock)
+        self.assertEqual(os.listdir(self.tmpdir), ["spark.tgz"])
+
+
 if __name__ == "__main__":
     sparkversion = "2.1.1"
     hadoopversion = "2.7"
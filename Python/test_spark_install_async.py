@@ -0,0 +1,214 @@
+import os
+import asyncio
+import unittest
+from unittest import mock
+
+import spark_install
+import spark_install_async
+from test_spark_install import _LocalTestCase
+from bench_spark_install import make_spark_archive
+
+
+class _StubClientError(Exception):
+    pass
+
+
+class _StubResponse(object):
+    # Reads through urllib in the executor, the part of aiohttp's response the download uses
+    def __init__(self, url):
+        self.url = url
+        self.response = None
+        self.content_length = None
+        self.content = self
+
+    async def __aenter__(self):
+        try:
+            self.response = await asyncio.get_event_loop().run_in_executor(None, spark_install._urlopen, self.url)
+        except IOError as e:
+            raise _StubClientError(e)
+        length = self.response.info().get("Content-Length")
+        self.content_length = int(length) if length is not None else None
+        return self
+
+    async def __aexit__(self, *args):
+        self.response.close()
+
+    def raise_for_status(self):
+        pass
+
+    async def iter_chunked(self, size):
+        while True:
+            block = await asyncio.get_event_loop().run_in_executor(None, self.response.read, size)
+            if not block:
+                return
+            yield block
+
+
+class _StubSession(object):
+    def __init__(self, timeout=None):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def get(self, url):
+        return _StubResponse(url)
+
+
+class _StubAiohttp(object):
+    ClientError = _StubClientError
+    ClientSession = _StubSession
+
+    @staticmethod
+    def ClientTimeout(total=None, sock_read=None):
+        return None
+
+
+class TestAsyncInstall(_LocalTestCase):
+    def setUp(self):
+        super(TestAsyncInstall, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        super(TestAsyncInstall, self).tearDown()
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_install_reports_progress(self):
+        component = self.serve_spark("2.1.1", "2.7")
+        progress = spark_install_async.SparkInstallProgress()
+        events = []
+
+        async def consume():
+            async for event in progress:
+                events.append(event)
+
+        async def install():
+            task = asyncio.ensure_future(spark_install_async.async_spark_install("2.1.1", "2.7", progress=progress))
+            await consume()
+            return await task
+
+        info = self.run_async(install())
+        self.assertEqual(info["spark_version_dir"], os.path.join(self.install_dir, component))
+        self.assertTrue(os.path.isfile(os.path.join(info["spark_conf_dir"], "log4j.properties")))
+        ended = [e["phase"] for e in events if e["event"] == "end"]
+        for phase in ("download", "extract", "configure", "env"):
+            self.assertIn(phase, ended)
+
+    def test_concurrent_installs_and_uninstall(self):
+        versions = [{"spark": "2.1.1", "hadoop": "2.7"}, {"spark": "2.2.0", "hadoop": "2.7"}]
+        for v in versions:
+            make_spark_archive(os.path.join(self.served, "spark-%s-bin-hadoop%s.tgz" % (v["spark"], v["hadoop"])), v["spark"], v["hadoop"])
+        self.write_catalog(versions)
+
+        async def install_all():
+            return await asyncio.gather(*[spark_install_async.async_spark_install(v["spark"], v["hadoop"]) for v in versions])
+
+        infos = self.run_async(install_all())
+        self.assertTrue(all(os.path.isdir(info["spark_version_dir"]) for info in infos))
+        self.assertEqual(len(self.run_async(spark_install_async.async_spark_versions())), 2)
+        self.run_async(spark_install_async.async_spark_uninstall("2.1.1", "2.7"))
+        self.assertFalse(os.path.isdir(infos[0]["spark_version_dir"]))
+
+    def test_concurrent_installs_of_one_version(self):
+        component = self.serve_spark("2.1.1", "2.7")
+
+        async def install_twice():
+            return await asyncio.gather(*[spark_install_async.async_spark_install("2.1.1", "2.7") for _ in range(2)])
+
+        infos = self.run_async(install_twice())
+        self.assertEqual([info["spark_version_dir"] for info in infos], [os.path.join(self.install_dir, component)] * 2)
+        self.assertTrue(os.path.isfile(os.path.join(infos[0]["spark_version_dir"], "bin", "spark-submit")))
+        self.assertEqual(len([r for r in self.server.requests if r[0].endswith(".tgz") and r[1] != "bytes=0-0"]), 1)
+        self.assertEqual([f for f in os.listdir(self.install_dir) if f.endswith(".part") or f.endswith(".lock")], [])
+
+    def test_reinstall_from_repacked_archive(self):
+        self.serve_spark("2.1.1", "2.7")
+        spark_install.spark_install("2.1.1", "2.7", repack=True)
+        spark_install.spark_uninstall("2.1.1", "2.7")
+        del self.server.requests[:]
+        info = self.run_async(spark_install_async.async_spark_install("2.1.1", "2.7"))
+        self.assertEqual(self.server.requests, [])
+        self.assertTrue(os.path.isfile(os.path.join(info["spark_version_dir"], "bin", "spark-submit")))
+
+    def test_waiting_for_the_lock_leaves_the_executor_free(self):
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(1)
+        self.loop.set_default_executor(executor)
+        path = os.path.join(self.install_dir, ".spark-2.1.1-bin-hadoop2.7.lock")
+        holder = spark_install._FileLock(path, remove=True).__enter__()
+
+        async def wait():
+            lock = await spark_install_async._acquire(spark_install._FileLock(path, 10, remove=True))
+            lock.__exit__(None, None, None)
+
+        async def scenario():
+            waiters = asyncio.gather(*[wait() for _ in range(3)])
+            await asyncio.sleep(0.2)
+            self.assertEqual(await asyncio.wait_for(spark_install_async._run(sum, [1, 2]), 2), 3)
+            holder.__exit__(None, None, None)
+            await waiters
+
+        try:
+            self.run_async(scenario())
+        finally:
+            executor.shutdown()
+        self.assertFalse(os.path.exists(path))
+
+    def test_cancel_removes_partial_download(self):
+        self.serve_spark("2.1.1", "2.7", {"jars/large.jar": os.urandom(2 * 1024 * 1024)})
+        self.server.throttle = 0.05
+
+        async def install_and_cancel():
+            task = asyncio.ensure_future(spark_install_async.async_spark_install("2.1.1", "2.7"))
+            await asyncio.sleep(0.3)
+            task.cancel()
+            await task
+
+        with self.assertRaises(asyncio.CancelledError):
+            self.run_async(install_and_cancel())
+        self.assertEqual(sorted(f for f in os.listdir(self.install_dir) if f.startswith("spark-")), [])
+
+
+class TestAiohttpInstall(TestAsyncInstall):
+    # Runs the async tests again through the aiohttp download path, with a stand-in when aiohttp
+    # isn't installed
+    def setUp(self):
+        super(TestAiohttpInstall, self).setUp()
+        patcher = mock.patch.object(spark_install_async, "aiohttp", spark_install_async.aiohttp or _StubAiohttp)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_download_goes_through_aiohttp(self):
+        self.serve_spark("2.1.1", "2.7")
+        with mock.patch.object(spark_install, "_download_file", side_effect=AssertionError("synchronous download")):
+            info = self.run_async(spark_install_async.async_spark_install("2.1.1", "2.7"))
+        self.assertTrue(os.path.isfile(os.path.join(info["spark_version_dir"], "bin", "spark-submit")))
+
+    def test_many_installs_of_one_version_share_a_small_executor(self):
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(2)
+        self.loop.set_default_executor(executor)
+        self.serve_spark("2.1.1", "2.7")
+
+        async def install_all():
+            return await asyncio.gather(*[spark_install_async.async_spark_install("2.1.1", "2.7") for _ in range(6)])
+
+        try:
+            with mock.patch.object(spark_install, "INSTALL_LOCK_TIMEOUT", 10):
+                infos = self.run_async(install_all())
+        finally:
+            executor.shutdown()
+        self.assertEqual(len(set(info["spark_version_dir"] for info in infos)), 1)
+        self.assertEqual(len([r for r in self.server.requests if r[0].endswith(".tgz")]), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()